@@ -0,0 +1,225 @@
+"""
+Vectorised analytics on the nC x nD price matrix returned by
+getPricesForGroup, one row per stock and one column per day. Every
+function works on all the stocks at once and on every day at once, the
+only loops in Python are over blocks of days to bound memory use.
+
+    days, prices, tickers = getPricesForGroup(con, tickers, '2015/01/01', '2016/01/01')
+    r = logReturns(prices)
+    vol = rollingVolatility(r, 20)
+    ends, corr = rollingCorrelation(r, 60, step=5)
+
+Rolling results have the same shape as their input, the first window - 1
+columns, where the window is not yet full, are NaN. Prices may be NaN
+where missing, as in the outer and ffill matrices from getPricesForGroup,
+and only the windows that include a missing value are NaN.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+##########################################
+
+# Trading days in a year, for annualising.
+tradingDaysPerYear = 252
+
+##########################################
+
+def logReturns(prices):
+    """
+    Daily log returns.
+
+    :param prices: nC x nD array of prices.
+
+    :return: nC x (nD - 1) array, column d is the return from day d to day d + 1.
+    """
+    prices = np.atleast_2d(np.asarray(prices, dtype=np.float))
+    return np.diff(np.log(prices), axis=1)
+
+##########################################
+
+def fillForward(prices):
+    """
+    Fill each missing price with the last price before it in its row, as
+    the ffill mode of getPricesForGroup. Prices before a stock's first
+    one stay NaN.
+
+    :param prices: nC x nD array of prices, NaN where missing.
+
+    :return: nC x nD array.
+    """
+    prices = np.atleast_2d(np.asarray(prices, dtype=np.float))
+    nC, nD = prices.shape
+
+    # Index of the last day with a price, on or before each day.
+    last = np.where(np.isfinite(prices), np.arange(nD), 0)
+    np.maximum.accumulate(last, axis=1, out=last)
+    return prices[np.arange(nC)[:, np.newaxis], last]
+
+##########################################
+
+def windowSums(x, window):
+    """
+    Sums over a sliding window along the rows of an array, computed from
+    cumulative sums. Missing values are taken as 0 in the cumulative sums,
+    so they do not spoil the windows after them, and a count of the values
+    present in each window marks the windows that had one.
+
+    :param x:      nC x nD array, NaN where missing.
+    :param window: Window length in days.
+
+    :return: nC x nD array, NaN where the window is not full or has a missing value.
+    """
+    nC, nD = x.shape
+    out = np.full((nC, nD), np.nan)
+
+    if window > nD:
+        return out
+
+    present = np.isfinite(x)
+
+    c = np.zeros((nC, nD + 1))
+    np.cumsum(np.where(present, x, 0), axis=1, out=c[:, 1:])
+
+    n = np.zeros((nC, nD + 1), dtype=np.int64)
+    np.cumsum(present, axis=1, out=n[:, 1:])
+
+    sums = c[:, window:] - c[:, :nD - window + 1]
+    full = (n[:, window:] - n[:, :nD - window + 1]) == window
+    out[:, window - 1:] = np.where(full, sums, np.nan)
+    return out
+
+##########################################
+
+def rollingMean(x, window):
+    """
+    Rolling mean along each row.
+
+    :param x:      nC x nD array, e.g. prices or returns.
+    :param window: Window length in days.
+
+    :return: nC x nD array, NaN where the window is not full or has a missing value.
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=np.float))
+    return windowSums(x, window) / window
+
+##########################################
+
+def rollingStd(x, window, ddof=1):
+    """
+    Rolling standard deviation along each row.
+
+    :param x:      nC x nD array.
+    :param window: Window length in days.
+    :param ddof:   Delta degrees of freedom, 1 for the sample standard deviation.
+
+    :return: nC x nD array, NaN where the window is not full or has a missing value.
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=np.float))
+
+    # Take off the mean of each row first, so the sums of squares do not
+    # lose precision. The mean is of the values present.
+    present = np.isfinite(x)
+    mean = np.where(present, x, 0).sum(axis=1) / np.maximum(present.sum(axis=1), 1)
+    x = x - mean[:, np.newaxis]
+
+    s1 = windowSums(x, window)
+    s2 = windowSums(x * x, window)
+
+    var = (s2 - s1 * s1 / window) / (window - ddof)
+    return np.sqrt(np.maximum(var, 0))
+
+##########################################
+
+def rollingVolatility(returns, window, annualise=True):
+    """
+    Rolling volatility of returns.
+
+    :param returns:   nC x nD array of daily returns, e.g. from logReturns.
+    :param window:    Window length in days.
+    :param annualise: Set to True to scale to a yearly figure.
+
+    :return: nC x nD array, NaN where the window is not full or has a missing value.
+    """
+    vol = rollingStd(returns, window)
+    if annualise:
+        vol *= np.sqrt(tradingDaysPerYear)
+    return vol
+
+##########################################
+
+def drawdowns(prices):
+    """
+    Drawdown of each stock on each day, relative to its highest price so far.
+
+    :param prices: nC x nD array of prices, NaN where missing.
+
+    :return: nC x nD array of drawdowns, 0 at a new high, -0.25 when 25% below
+             the high, NaN where the price is missing.
+    """
+    prices = np.atleast_2d(np.asarray(prices, dtype=np.float))
+    # fmax passes over NaN, where maximum would carry it to every later day.
+    peaks = np.fmax.accumulate(prices, axis=1)
+    return prices / peaks - 1
+
+##########################################
+
+def maxDrawdowns(prices):
+    """
+    Worst drawdown of each stock over the whole period.
+
+    :param prices: nC x nD array of prices, NaN where missing.
+
+    :return: Array of length nC.
+    """
+    return np.fmin.reduce(drawdowns(prices), axis=1)
+
+##########################################
+
+def rollingCorrelation(x, window, step=1, blockSize=None):
+    """
+    Correlation between every pair of rows over a sliding window.
+
+    Each window's correlation matrix comes from one matrix product of the
+    window's (demeaned) values with their transpose, done for a block of
+    windows at a time on a strided view of the data, so nothing is copied
+    for each window.
+
+    :param x:         nC x nD array, usually returns.
+    :param window:    Window length in days.
+    :param step:      Days between the ends of successive windows.
+    :param blockSize: Number of windows handled at a time, chosen to keep
+                      the temporary arrays to tens of megabytes if not given.
+
+    :return: Array of the index of the last day of each window, and an
+             nW x nC x nC array of correlation matrices, one for each window.
+    """
+    x = np.ascontiguousarray(np.atleast_2d(np.asarray(x, dtype=np.float)))
+    nC, nD = x.shape
+
+    ends = np.arange(window - 1, nD, step)
+    nW = len(ends)
+
+    corr = np.zeros((nW, nC, nC))
+
+    if nW == 0:
+        return ends, corr
+
+    if blockSize == None:
+        blockSize = max(1, int(4e6 // (nC * window + nC * nC)))
+
+    # View of all windows, shape nW x nC x window, without copying.
+    s0, s1 = x.strides
+    windows = as_strided(x, shape=(nW, nC, window), strides=(step * s1, s0, s1))
+
+    for b in range(0, nW, blockSize):
+        w = windows[b:b + blockSize]
+        w = w - w.mean(axis=2)[:, :, np.newaxis]
+
+        cov = np.matmul(w, w.transpose(0, 2, 1))
+
+        sd = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr[b:b + blockSize] = cov / (sd[:, :, np.newaxis] * sd[:, np.newaxis, :])
+
+    return ends, corr
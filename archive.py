@@ -0,0 +1,336 @@
+"""
+Compact archives of the prices table, for backups, daily snapshots and
+moving the data between machines. Much smaller than the database file and
+quicker to load than downloading the prices again.
+
+An archive is a zip file with a manifest.json and, for each stock, one
+member per column of its prices in date order:
+
+    Date    day numbers as differences from the previous day, the first
+            day being kept in the manifest.
+    Open, High, Low, Close, Volume
+            if every value is a whole number of 1/10^k units (k up to 6),
+            e.g. prices in pence to two places, the integers as differences
+            from the previous one ('fixed'); otherwise the bits of each
+            double XORed with those of the previous one ('xor'). Both give
+            back exactly the values stored.
+
+Values are written with their bytes shuffled (all first bytes, then all
+second bytes, ...) which, together with the small differences, leaves
+long runs of zero bytes for the compression. The manifest has the number
+of rows, the first and last day and a SHA-1 of the values of each column,
+checked when the archive is loaded.
+
+    python archive.py export snapshot.zip [tickers ...]
+    python archive.py import snapshot.zip [tickers ...]
+"""
+
+import sys, os, json, zipfile, hashlib, datetime, sqlite3
+import numpy as np
+from db_conn import getManager
+from ingest import tuneForBulkLoad
+from tr_utils import *
+
+##########################################
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+archiveFormat = 'tr-prices-archive'
+archiveVersion = 1
+
+valueColumns = ('Open', 'High', 'Low', 'Close', 'Volume')
+
+# Most decimal places tried for the fixed point encoding.
+maxDecimals = 6
+
+##########################################
+
+def shuffleBytes(a):
+    """
+    :return: The bytes of an array, grouped by their position in each element.
+    """
+    a = np.ascontiguousarray(a)
+    return a.view(np.uint8).reshape(len(a), a.dtype.itemsize).T.tobytes()
+
+##########################################
+
+def unshuffleBytes(buf, dtype):
+    """
+    Reverse shuffleBytes.
+
+    :param buf:   The bytes.
+    :param dtype: Type of the elements.
+
+    :return: The array.
+    """
+    dtype = np.dtype(dtype)
+    b = np.frombuffer(buf, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(b.T).view(dtype).ravel()
+
+##########################################
+
+def columnChecksum(values):
+    """
+    :return: SHA-1 hex digest of the values of a column as little endian doubles.
+    """
+    return hashlib.sha1(np.asarray(values, dtype='<f8').tobytes()).hexdigest()
+
+##########################################
+
+def smallestIntType(a):
+    """
+    :return: '<i4' if every element of an integer array fits in 32 bits, '<i8' if not.
+    """
+    if len(a) == 0 or (a.min() >= -2**31 and a.max() < 2**31):
+        return '<i4'
+    return '<i8'
+
+##########################################
+
+def encodeDates(days):
+    """
+    Encode a column of increasing day numbers.
+
+    :param days: Integer array.
+
+    :return: The bytes and a dictionary describing the encoding for the manifest.
+    """
+    days = np.asarray(days, dtype=np.int64)
+    deltas = np.diff(days)
+    dtype = smallestIntType(deltas)
+
+    info = {'encoding': 'delta',
+            'dtype': dtype,
+            'first': int(days[0]),
+            'sha1': columnChecksum(days)}
+    return shuffleBytes(deltas.astype(dtype)), info
+
+##########################################
+
+def decodeDates(buf, info):
+    deltas = unshuffleBytes(buf, info['dtype']).astype(np.int64)
+    days = np.empty(len(deltas) + 1, dtype=np.int64)
+    days[0] = info['first']
+    np.cumsum(deltas, out=days[1:])
+    days[1:] += info['first']
+    return days
+
+##########################################
+
+def fixedDecimals(values):
+    """
+    Find the fewest decimal places that give back every value exactly.
+
+    :param values: Array of doubles.
+
+    :return: The number of decimal places, None if more than maxDecimals are needed.
+    """
+    if not np.isfinite(values).all():
+        return None
+
+    for k in range(maxDecimals + 1):
+        scaled = np.round(values * 10**k)
+        if np.abs(scaled).max() >= 2**53:
+            return None
+        if np.array_equal(scaled / 10**k, values):
+            return k
+    return None
+
+##########################################
+
+def encodeValues(values):
+    """
+    Encode a column of prices or volumes.
+
+    :param values: Array of doubles.
+
+    :return: The bytes and a dictionary describing the encoding for the manifest.
+    """
+    values = np.asarray(values, dtype=np.float)
+
+    info = {'sha1': columnChecksum(values)}
+
+    k = fixedDecimals(values)
+    if k != None:
+        ints = np.round(values * 10**k).astype(np.int64)
+        deltas = np.diff(ints)
+        dtype = smallestIntType(deltas)
+        info.update({'encoding': 'fixed', 'decimals': k, 'dtype': dtype, 'first': int(ints[0])})
+        return shuffleBytes(deltas.astype(dtype)), info
+
+    bits = values.astype('<f8').view('<u8')
+    xored = bits.copy()
+    xored[1:] ^= bits[:-1]
+    info.update({'encoding': 'xor', 'dtype': '<u8'})
+    return shuffleBytes(xored), info
+
+##########################################
+
+def decodeValues(buf, info):
+    if info['encoding'] == 'fixed':
+        deltas = unshuffleBytes(buf, info['dtype']).astype(np.int64)
+        ints = np.empty(len(deltas) + 1, dtype=np.int64)
+        ints[0] = info['first']
+        np.cumsum(deltas, out=ints[1:])
+        ints[1:] += info['first']
+        if info['decimals'] == 0:
+            return ints
+        return ints / float(10**info['decimals'])
+
+    xored = unshuffleBytes(buf, '<u8')
+    return np.bitwise_xor.accumulate(xored).view('<f8')
+
+##########################################
+
+def exportArchive(dbCon, fileName, tickers=None, verbose=False):
+    """
+    Write the prices of a set of stocks to an archive.
+
+    :param dbCon:    Database connection.
+    :param fileName: The zip file to write.
+    :param tickers:  The stocks, all those in the prices table if not specified.
+    :param verbose:  Set to True to print each stock written.
+
+    :return: Number of stocks and number of rows written.
+    """
+    if tickers == None:
+        tickers = [x[0] for x in executeQuery(dbCon, 'SELECT DISTINCT Ticker FROM prices ORDER BY Ticker')]
+
+    queryStr = ('SELECT Date, ' + ', '.join(valueColumns) + ' FROM prices ' +
+                'WHERE Ticker = ? ORDER BY Date')
+
+    manifest = {'format': archiveFormat,
+                'version': archiveVersion,
+                'created': datetime.datetime.now().isoformat(),
+                'tickers': []}
+    nRows = 0
+
+    tmpName = fileName + '.tmp'
+    with zipfile.ZipFile(tmpName, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for n, ticker in enumerate(tickers):
+            r = executeQuery2(dbCon, queryStr, (ticker,))
+            if len(r) == 0:
+                continue
+
+            cols = zip(*r)
+            prefix = 'prices/{:05d}/'.format(n)
+
+            buf, dateInfo = encodeDates(cols[0])
+            zf.writestr(prefix + 'Date', buf)
+
+            entry = {'ticker': ticker,
+                     'prefix': prefix,
+                     'rows': len(r),
+                     'firstDay': int(cols[0][0]),
+                     'lastDay': int(cols[0][-1]),
+                     'columns': {'Date': dateInfo}}
+
+            for name, values in zip(valueColumns, cols[1:]):
+                buf, entry['columns'][name] = encodeValues(np.asarray(values, dtype=np.float))
+                zf.writestr(prefix + name, buf)
+
+            manifest['tickers'].append(entry)
+            nRows += len(r)
+
+            if verbose:
+                print '{:s}: {:d} rows'.format(ticker, len(r))
+
+        manifest['nTickers'] = len(manifest['tickers'])
+        manifest['nRows'] = nRows
+        zf.writestr('manifest.json', json.dumps(manifest, indent=1, sort_keys=True))
+
+    os.rename(tmpName, fileName)
+
+    return manifest['nTickers'], nRows
+
+##########################################
+
+def readManifest(fileName):
+    """
+    :return: The manifest of an archive, as a dictionary.
+    """
+    with zipfile.ZipFile(fileName) as zf:
+        manifest = json.loads(zf.read('manifest.json'))
+
+    if manifest.get('format') != archiveFormat or manifest.get('version') > archiveVersion:
+        raise Exception('readManifest: {:s}, not a prices archive this version can read.'.format(fileName))
+
+    return manifest
+
+##########################################
+
+def importArchive(dbCon, fileName, tickers=None, verify=True, verbose=False):
+    """
+    Load the prices in an archive into the prices table. Rows already in
+    the table are left as they are. Insert hooks are called once, after
+    the last stock, see deferInsertHooks.
+
+    :param dbCon:    Database connection.
+    :param fileName: The zip file.
+    :param tickers:  The stocks to load, all those in the archive if not specified.
+    :param verify:   Set to False to skip comparing the checksums.
+    :param verbose:  Set to True to print each stock loaded.
+
+    :return: Number of rows read from the archive.
+    """
+    manifest = readManifest(fileName)
+
+    if tickers != None:
+        tickers = set(tickers)
+
+    tuneForBulkLoad(dbCon)
+
+    nRows = 0
+    with zipfile.ZipFile(fileName) as zf, deferInsertHooks(dbCon):
+        for entry in manifest['tickers']:
+            ticker = entry['ticker']
+            if tickers != None and ticker not in tickers:
+                continue
+
+            info = entry['columns']
+            columns = [ticker, decodeDates(zf.read(entry['prefix'] + 'Date'), info['Date'])]
+            for name in valueColumns:
+                columns.append(decodeValues(zf.read(entry['prefix'] + name), info[name]))
+
+            if verify:
+                for name, values in zip(('Date',) + valueColumns, columns[1:]):
+                    if len(values) != entry['rows'] or columnChecksum(values) != info[name]['sha1']:
+                        raise Exception('importArchive: {:s}, {:s} {:s} does not match the manifest.'
+                                        .format(fileName, ticker, name))
+
+            insertColumnsIntoDB(dbCon, 'prices', columns,
+                                spans={ticker: (entry['firstDay'], entry['lastDay'])})
+            nRows += entry['rows']
+
+            if verbose:
+                print '{:s}: {:d} rows'.format(ticker, entry['rows'])
+
+    return nRows
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3 or sys.argv[1] not in ('export', 'import'):
+        print 'Usage: python archive.py export|import archive.zip [tickers ...]'
+        sys.exit(1)
+
+    fileName = sys.argv[2]
+    tickers = sys.argv[3:] or None
+
+    con = getManager(dbFileFull).writeConnection()
+
+    # Keep the sector indices, bars and other tables made from the prices
+    # up to date, as for downloads.
+    import get_prices
+    get_prices.enableAutoRefresh()
+
+    if sys.argv[1] == 'export':
+        nTickers, nRows = exportArchive(con, fileName, tickers=tickers)
+        print 'Wrote {:d} rows for {:d} stocks, {:d} bytes.'.format(nRows, nTickers,
+                                                                    os.path.getsize(fileName))
+    else:
+        nRows = importArchive(con, fileName, tickers=tickers)
+        print 'Read {:d} rows.'.format(nRows)
@@ -0,0 +1,268 @@
+"""
+Vectorised backtests of simple trading rules on the nC x nD price matrix
+returned by getPricesForGroup. Signals, positions and P&L are worked out
+for every stock and every day at once, there are no loops over either.
+
+A signal function takes the price matrix and gives a matrix of the same
+shape of target positions between -1 (short) and 1 (long), decided on
+the close of each day. The position is held from that close to the next,
+so the P&L on day d is the position decided on day d - 1 times the return
+from day d - 1 to day d.
+
+    days, prices, tickers = getPricesForGroup(con, tickers, '2014/04/01', '2016/04/01')
+    result = backtest(prices, maCrossover(prices, fast=20, slow=100), cost=0.001)
+    print result['stats']
+
+The portfolio holds an equal share of capital in each stock, so its
+return is the mean over the stocks of their P&L.
+
+Prices may be NaN where missing, e.g. from the outer mode of
+getPricesForGroup. Signals are worked out on the prices filled forward,
+so a gap does not blank the windows after it, and nothing is held in a
+stock on a day it has no price.
+"""
+
+import sys, time
+import numpy as np
+from analytics import fillForward, rollingMean, rollingStd, drawdowns, tradingDaysPerYear
+from tr_utils import *
+
+##########################################
+
+def maCrossover(prices, fast=20, slow=50, longOnly=False):
+    """
+    Long when the fast moving average is above the slow one, short (or
+    out if longOnly) when below.
+
+    :param prices:   nC x nD array of prices.
+    :param fast:     Window of the fast moving average in days.
+    :param slow:     Window of the slow moving average in days.
+    :param longOnly: Set to True to hold nothing instead of going short.
+
+    :return: nC x nD array of positions, 0 until the slow window is full.
+    """
+    prices = fillForward(prices)
+    diff = rollingMean(prices, fast) - rollingMean(prices, slow)
+    signal = np.sign(np.nan_to_num(diff))
+    if longOnly:
+        signal = np.maximum(signal, 0)
+    return signal
+
+##########################################
+
+def momentum(prices, lookback=60, longOnly=False):
+    """
+    Long stocks that have gone up over the lookback, short those that have
+    gone down.
+
+    :param prices:   nC x nD array of prices.
+    :param lookback: Days over which the change in price is measured.
+    :param longOnly: Set to True to hold nothing instead of going short.
+
+    :return: nC x nD array of positions, 0 for the first lookback days.
+    """
+    prices = fillForward(prices)
+
+    change = np.zeros(prices.shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        change[:, lookback:] = prices[:, lookback:] / prices[:, :-lookback] - 1
+
+    signal = np.sign(np.nan_to_num(change))
+    if longOnly:
+        signal = np.maximum(signal, 0)
+    return signal
+
+##########################################
+
+def meanReversion(prices, window=20, threshold=1.0):
+    """
+    Short stocks more than threshold standard deviations above their moving
+    average and long those more than threshold below it.
+
+    :param prices:    nC x nD array of prices.
+    :param window:    Window of the moving average in days.
+    :param threshold: Number of standard deviations from the average to trade at.
+
+    :return: nC x nD array of positions, 0 until the window is full.
+    """
+    prices = fillForward(prices)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (prices - rollingMean(prices, window)) / rollingStd(prices, window)
+    z = np.nan_to_num(z)
+
+    return (z < -threshold).astype(np.float) - (z > threshold)
+
+##########################################
+
+# Signal functions by name, e.g. for the command line or a parameter sweep.
+signals = {'crossover': maCrossover,
+           'momentum': momentum,
+           'meanReversion': meanReversion}
+
+##########################################
+
+def dailyReturns(prices):
+    """
+    Simple daily returns, the same shape as the prices. Returns for the
+    first day, and to or from a missing price, are 0.
+
+    :param prices: nC x nD array of prices, NaN where missing.
+
+    :return: nC x nD array, column d is the return from day d - 1 to day d.
+    """
+    prices = np.atleast_2d(np.asarray(prices, dtype=np.float))
+
+    r = np.zeros(prices.shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r[:, 1:] = prices[:, 1:] / prices[:, :-1] - 1
+    r[~np.isfinite(r)] = 0
+    return r
+
+##########################################
+
+def summaryStats(returns, turnover, pnl=None):
+    """
+    Summary statistics for a daily return series.
+
+    :param returns:  Array of daily portfolio returns, net of costs.
+    :param turnover: Array of daily portfolio turnover.
+    :param pnl:      Optional nC x nD array of P&L of each stock, for the
+                     Sharpe ratio of each stock.
+
+    :return: Dictionary of statistics, annualised where it makes sense.
+    """
+    n = len(returns)
+    equity = np.cumprod(1 + returns)
+
+    mean = returns.mean() if n > 0 else 0.0
+    sd = returns.std(ddof=1) if n > 1 else 0.0
+
+    stats = {'days': n,
+             'totalReturn': equity[-1] - 1 if n > 0 else 0.0,
+             'annualReturn': equity[-1] ** (tradingDaysPerYear / float(n)) - 1 if n > 0 else 0.0,
+             'annualVolatility': sd * np.sqrt(tradingDaysPerYear),
+             'sharpe': mean / sd * np.sqrt(tradingDaysPerYear) if sd > 0 else 0.0,
+             'maxDrawdown': drawdowns(np.concatenate(([1.0], equity))).min(),
+             'meanTurnover': turnover.mean() if n > 0 else 0.0,
+             'hitRate': (returns > 0).sum() / float(max((returns != 0).sum(), 1))}
+
+    if pnl is not None:
+        m = pnl.mean(axis=1)
+        s = pnl.std(axis=1, ddof=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stats['sharpeByStock'] = np.where(s > 0, m / s, 0) * np.sqrt(tradingDaysPerYear)
+
+    return stats
+
+##########################################
+
+def backtest(prices, signal, cost=0.0):
+    """
+    Work out the positions, P&L, turnover and summary statistics of a
+    signal applied to a set of stocks.
+
+    :param prices: nC x nD array of prices, NaN where missing.
+    :param signal: nC x nD array of target positions from a signal function.
+    :param cost:   Cost of trading as a fraction of the value traded, e.g.
+                   0.001 for 10 basis points.
+
+    :return: Dictionary with
+             positions: nC x nD positions held over each day,
+             pnl:       nC x nD daily P&L of each stock, before costs,
+             returns:   daily portfolio returns, net of costs,
+             equity:    growth of 1 invested,
+             turnover:  daily portfolio turnover,
+             stats:     see summaryStats.
+    """
+    prices = np.atleast_2d(np.asarray(prices, dtype=np.float))
+    signal = np.atleast_2d(np.asarray(signal, dtype=np.float))
+    nC, nD = prices.shape
+
+    # Nothing is held in a stock without a price.
+    signal = np.where(np.isfinite(prices), signal, 0)
+
+    positions = np.zeros((nC, nD))
+    positions[:, 1:] = signal[:, :-1]
+
+    pnl = positions * dailyReturns(prices)
+
+    traded = np.zeros((nC, nD))
+    traded[:, 0] = np.abs(positions[:, 0])
+    traded[:, 1:] = np.abs(np.diff(positions, axis=1))
+    turnover = traded.mean(axis=0)
+
+    returns = pnl.mean(axis=0) - cost * turnover
+
+    # The first day has no return.
+    returns, turnover = returns[1:], turnover[1:]
+
+    return {'positions': positions,
+            'pnl': pnl,
+            'returns': returns,
+            'equity': np.cumprod(1 + returns),
+            'turnover': turnover,
+            'stats': summaryStats(returns, turnover, pnl[:, 1:])}
+
+##########################################
+
+def runBacktest(dbCon, tickers, start_date_str, end_date_str, signalName, cost=0.0, **params):
+    """
+    Load the prices of a set of stocks and backtest a signal on them.
+
+    :param dbCon:          Database connection.
+    :param tickers:        The stocks.
+    :param start_date_str: Start date, inclusive.
+    :param end_date_str:   End date, exclusive.
+    :param signalName:     Key of the signals dictionary.
+    :param cost:           Cost of trading, see backtest.
+    :param params:         Parameters for the signal function.
+
+    :return: The tickers used and the result of backtest, an empty list
+             and None if there are no prices.
+    """
+    r = getPricesForGroup(dbCon, tickers, start_date_str, end_date_str)
+    if r == None or len(r[2]) == 0:
+        return [], None
+
+    days, prices, tickersKept = r
+
+    signal = signals[signalName](prices, **params)
+    return tickersKept, backtest(prices, signal, cost=cost)
+
+
+if __name__ == '__main__':
+
+    from db_conn import getManager
+
+    dataDir = 'data'
+    dbFile = 'trade_data'
+    dbFileFull = dataDir + '/' + dbFile + '.db'
+
+    startDate = '2014/04/01'
+    endDate = datetime.date.today().strftime('%Y/%m/%d')
+    if len(sys.argv) > 1:
+        startDate = sys.argv[1]
+
+    with getManager(dbFileFull).reader() as con:
+        tickers = [x[0] for x in executeQuery(con, 'SELECT ticker FROM companies')]
+        r = getPricesForGroup(con, tickers, startDate, endDate)
+
+    if r == None:
+        print 'No prices between {:s} and {:s}'.format(startDate, endDate)
+        sys.exit(1)
+
+    days, prices, tickers = r
+
+    print 'Backtests on {:d} stocks over {:d} days'.format(len(tickers), len(days))
+
+    for name, params in [('crossover', {'fast': 20, 'slow': 100}),
+                         ('momentum', {'lookback': 60}),
+                         ('meanReversion', {'window': 20, 'threshold': 1.5})]:
+        t0 = time.time()
+        result = backtest(prices, signals[name](prices, **params), cost=0.001)
+        dt = time.time() - t0
+
+        stats = result['stats']
+        print ('{:14s} sharpe {:6.2f}  return {:7.2%}  max drawdown {:7.2%}  ' +
+               'turnover {:5.3f}  ({:.3f} s)').format(name, stats['sharpe'], stats['annualReturn'],
+                                                      stats['maxDrawdown'], stats['meanTurnover'], dt)
@@ -0,0 +1,293 @@
+"""
+Benchmarks for the hot paths: inserting prices, reading one stock over a
+date range, aligning a group of stocks and planning updates. The data are
+synthetic, made by scaling up the FTSE companies file to the number of
+stocks wanted and giving each a random walk of daily prices.
+
+Results are written as JSON so that runs can be compared, e.g.
+
+    python benchmark.py small medium > before.json
+    ... make changes ...
+    python benchmark.py small medium > after.json
+    python benchmark.py --compare before.json after.json
+
+"""
+
+import sys, os, json, time, datetime, tempfile, shutil, platform, sqlite3
+import numpy as np
+from tr_utils import *
+
+##########################################
+
+# To persuade sqlite to interpret numpy data types correctly.
+# http://stackoverflow.com/questions/11910584/sqlite3-writes-only-floating-point-numpy-arrays-not-integer-ones
+sqlite3.register_adapter(np.int64, int)
+
+dataDir = 'data'
+companiesFile = dataDir + '/ftse-companies-2016-05.csv'
+
+# Number of stocks and years of daily prices at each scale.
+scales = {'tiny':   (20, 1),
+          'small':  (100, 2),
+          'medium': (500, 10),
+          'large':  (2000, 30)}
+
+# Last day of the synthetic prices.
+endDateStr = '2016/03/31'
+
+##########################################
+
+def createTables(dbCon):
+    """
+    Create the companies and prices tables, as done by init-db.
+
+    :param dbCon: Database connection.
+    """
+    cur = dbCon.cursor()
+    cur.execute('CREATE TABLE companies(companyName TEXT, ticker TEXT PRIMARY KEY, ' +
+                'sector TEXT, marketCap FLOAT, employees INT)')
+    cur.execute('CREATE TABLE prices(Ticker TEXT, Date INTEGER, Open FLOAT, High FLOAT, ' +
+                'Low FLOAT, Close FLOAT, Volume INTEGER, ' +
+                'CONSTRAINT prices_pk PRIMARY KEY (Ticker, Date))')
+    dbCon.commit()
+
+##########################################
+
+def makeCompanies(nTickers):
+    """
+    Make a list of companies by repeating those in the FTSE file, with a
+    number added to the ticker after the first copy.
+
+    :param nTickers: Number of companies wanted.
+
+    :return: List of (companyName, ticker, sector, marketCap, employees) tuples.
+    """
+    base = np.atleast_1d(np.genfromtxt(companiesFile, delimiter=',',
+                                       dtype='S60,S10,S30,float,int',
+                                       skip_header=1)).tolist()
+
+    companies = []
+    for n in range(nTickers):
+        name, ticker, sector, cap, employees = base[n % len(base)]
+        copy = n // len(base)
+        if copy > 0:
+            name = '{:s} {:d}'.format(name, copy)
+            ticker = '{:s}{:d}'.format(ticker, copy)
+        companies.append((name, ticker, sector, cap, employees))
+
+    return companies
+
+##########################################
+
+def makePrices(ticker, days, rng):
+    """
+    Make a random walk of daily prices for a stock.
+
+    :param ticker: The stock.
+    :param days:   Array of day numbers to give prices for.
+    :param rng:    numpy RandomState.
+
+    :return: List of rows for the prices table.
+    """
+    n = len(days)
+    close = 100.0 * np.exp(np.cumsum(rng.normal(0, 0.015, n)))
+    openP = close * (1 + rng.normal(0, 0.003, n))
+    high = np.maximum(openP, close) * (1 + np.abs(rng.normal(0, 0.005, n)))
+    low = np.minimum(openP, close) * (1 - np.abs(rng.normal(0, 0.005, n)))
+    volume = rng.randint(1000, 1000000, n)
+
+    return zip([ticker] * n, days.tolist(), openP.tolist(), high.tolist(),
+               low.tolist(), close.tolist(), volume.tolist())
+
+##########################################
+
+def weekdays(startDay, endDay):
+    """
+    :return: Array of the day numbers of the weekdays in [startDay, endDay).
+    """
+    days = np.arange(startDay, endDay)
+    # Day 0, 1970/01/01, was a Thursday.
+    return days[(days + 3) % 7 < 5]
+
+##########################################
+
+def timeCall(func, repeat=1):
+    """
+    Time a function.
+
+    :param func:   Function taking no arguments.
+    :param repeat: Number of times to call it.
+
+    :return: Dictionary with the number of calls and the total, mean, min and max seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+
+    return {'calls': repeat,
+            'total': sum(times),
+            'mean': sum(times) / repeat,
+            'min': min(times),
+            'max': max(times)}
+
+##########################################
+
+def runScale(name, nTickers, nYears, seed=0, workDir=None):
+    """
+    Build a synthetic database at one scale and time the hot paths on it.
+
+    :param name:     Name of the scale, for the results.
+    :param nTickers: Number of stocks.
+    :param nYears:   Years of daily prices.
+    :param seed:     Seed for the random data.
+    :param workDir:  Directory for the database, a temporary one if not specified.
+
+    :return: Dictionary of results.
+    """
+    rng = np.random.RandomState(seed)
+
+    tmpDir = workDir
+    if tmpDir == None:
+        tmpDir = tempfile.mkdtemp(prefix='tr-bench-')
+
+    dbFileName = os.path.join(tmpDir, 'bench-{:s}.db'.format(name))
+    if os.path.isfile(dbFileName):
+        os.remove(dbFileName)
+
+    dbCon = sqlite3.connect(dbFileName)
+    createTables(dbCon)
+
+    companies = makeCompanies(nTickers)
+    insertDataIntoDB(dbCon, 'companies', companies)
+    tickers = [c[1] for c in companies]
+
+    endDay = dateToDay(endDateStr)
+    days = weekdays(endDay - int(365.25 * nYears), endDay)
+
+    startStr = dayToDate(days[0])
+    midStr = dayToDate(days[len(days) // 2])
+    endStr = dayToDate(endDay)
+    yearStr = dayToDate(endDay - 365)
+
+    timings = {}
+
+    # Ingest, one insert per stock as done by get_prices.
+    rows = [makePrices(t, days, rng) for t in tickers]
+    it = iter(rows)
+    timings['ingest'] = timeCall(lambda: insertDataIntoDB(dbCon, 'prices', next(it)),
+                                 repeat=len(rows))
+    timings['ingest']['rows'] = len(days) * nTickers
+    timings['ingest']['rowsPerSecond'] = timings['ingest']['rows'] / timings['ingest']['total']
+    rows = None
+
+    # Single stock range reads, last year and full history.
+    picks = rng.choice(tickers, size=min(50, nTickers), replace=False).tolist()
+    it = iter(picks)
+    timings['readYear'] = timeCall(lambda: getTimeAndPriceData(dbCon, next(it), yearStr, endStr),
+                                   repeat=len(picks))
+    it = iter(picks)
+    timings['readAll'] = timeCall(lambda: getTimeAndPriceData(dbCon, next(it), startStr, endStr),
+                                  repeat=len(picks))
+
+    # Alignment of the whole universe, last year and half the history.
+    timings['groupYear'] = timeCall(lambda: getPricesForGroup(dbCon, tickers, yearStr, endStr),
+                                    repeat=3)
+    timings['groupHalf'] = timeCall(lambda: getPricesForGroup(dbCon, tickers, midStr, endStr),
+                                    repeat=1)
+
+    # Planning an update a week after the last prices.
+    planEnd = dayToDate(endDay + 7, sep='-')
+    timings['planUpdates'] = timeCall(lambda: planUpdates(dbCon, tickers, end_date_str=planEnd),
+                                      repeat=5)
+
+    dbCon.close()
+
+    dbBytes = os.path.getsize(dbFileName)
+
+    if workDir == None:
+        shutil.rmtree(tmpDir)
+
+    return {'scale': name,
+            'tickers': nTickers,
+            'years': nYears,
+            'days': len(days),
+            'rows': len(days) * nTickers,
+            'dbBytes': dbBytes,
+            'timings': timings}
+
+##########################################
+
+def runBenchmarks(scaleNames, seed=0):
+    """
+    Run the benchmarks at a set of scales.
+
+    :param scaleNames: Names of scales, keys of the scales dictionary.
+    :param seed:       Seed for the random data.
+
+    :return: Dictionary of results, ready to write as JSON.
+    """
+    results = {'created': datetime.datetime.now().isoformat(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'sqlite': sqlite3.sqlite_version,
+               'machine': platform.platform(),
+               'seed': seed,
+               'runs': []}
+
+    # The synthetic prices must not reach any store kept in sync by an
+    # insert hook, e.g. a column store or covariance state in data.
+    savedHooks = list(insertHooks)
+    del insertHooks[:]
+
+    try:
+        for name in scaleNames:
+            nTickers, nYears = scales[name]
+            sys.stderr.write('benchmark: {:s}, {:d} stocks, {:d} years\n'.format(name, nTickers, nYears))
+            results['runs'].append(runScale(name, nTickers, nYears, seed=seed))
+    finally:
+        insertHooks[:] = savedHooks
+
+    return results
+
+##########################################
+
+def compareResults(before, after):
+    """
+    Print the ratio of mean times between two sets of results for each
+    scale and benchmark they share. Ratios above 1 are slower.
+
+    :param before: Results from runBenchmarks.
+    :param after:  Results from runBenchmarks.
+    """
+    runsBefore = dict((r['scale'], r) for r in before['runs'])
+
+    for run in after['runs']:
+        if run['scale'] not in runsBefore:
+            continue
+        old = runsBefore[run['scale']]['timings']
+        for key in sorted(run['timings']):
+            if key not in old:
+                continue
+            t0 = old[key]['mean']
+            t1 = run['timings'][key]['mean']
+            print '{:8s} {:12s} {:10.5f} {:10.5f} {:6.2f}'.format(run['scale'], key, t0, t1, t1 / t0)
+
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+
+    if len(args) == 3 and args[0] == '--compare':
+        with open(args[1]) as f:
+            before = json.load(f)
+        with open(args[2]) as f:
+            after = json.load(f)
+        compareResults(before, after)
+
+    else:
+        if len(args) == 0:
+            args = ['tiny', 'small']
+
+        print json.dumps(runBenchmarks(args), indent=1, sort_keys=True)
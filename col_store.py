@@ -0,0 +1,249 @@
+"""
+A columnar copy of the prices table, kept on disk as numpy files so that
+analysis scripts can memory map the price histories instead of rebuilding
+arrays from the database each time. Several processes reading the same
+store share the pages of the files.
+
+The layout is one directory per stock with one .npy file per column, and
+an index.json file with the row count and first and last day of each stock.
+
+Run as a script to build the store from the prices table. Call enableSync
+on a store to have it updated after each insertDataIntoDB, which reads
+only the days written for each stock from the database.
+"""
+
+import os, json, sqlite3
+import numpy as np
+from db_conn import getManager
+from tr_utils import executeQuery, executeQueryArray, registerInsertHook, removeInsertHook
+
+##########################################
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+# Default place for the store.
+storeDirDefault = dataDir + '/colstore'
+
+# Columns of the prices table held in the store and their types.
+columnNames = ['Date', 'Open', 'High', 'Low', 'Close', 'Volume']
+columnTypes = [np.int64, np.float64, np.float64, np.float64, np.float64, np.int64]
+
+columnDtype = list(zip(columnNames, columnTypes))
+
+##########################################
+
+def saveArray(fileName, arr):
+    """
+    Write an array to a .npy file, replacing any existing file in one step
+    so that readers never see a half written file. Readers that already
+    have the old file mapped keep their view of it.
+
+    :param fileName: The file to write.
+    :param arr:      The array.
+    """
+    tmpName = fileName + '.tmp'
+    with open(tmpName, 'wb') as f:
+        np.save(f, arr)
+    os.rename(tmpName, fileName)
+
+##########################################
+
+class ColumnStore(object):
+    """
+    Memory mapped columnar copy of the prices table.
+    """
+
+    def __init__(self, storeDir=storeDirDefault):
+        """
+        :param storeDir: Directory holding the store, created if needed.
+        """
+        self.storeDir = storeDir
+        self.indexFile = os.path.join(storeDir, 'index.json')
+
+        # Open memory maps, with the file identity they were opened for.
+        self.maps = {}
+
+        if not os.path.isdir(storeDir):
+            os.makedirs(storeDir)
+
+        self.loadIndex()
+
+    def loadIndex(self):
+        """
+        Read the index of the stocks in the store.
+        """
+        if os.path.isfile(self.indexFile):
+            with open(self.indexFile) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def saveIndex(self):
+        """
+        Write the index of the stocks in the store.
+        """
+        tmpName = self.indexFile + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.rename(tmpName, self.indexFile)
+
+    def tickers(self):
+        """
+        :return: Sorted list of the stocks in the store.
+        """
+        return sorted(self.index.keys())
+
+    def columnFile(self, ticker, name):
+        return os.path.join(self.storeDir, ticker, name + '.npy')
+
+    def writeTicker(self, dbCon, ticker, fromDay=None, saveIndex=True):
+        """
+        Copy the price history of a stock from the database into the store.
+
+        :param dbCon:     Database connection.
+        :param ticker:    The stock.
+        :param fromDay:   Day number, only the rows from this day on are read
+                          from the database and merged with the earlier rows
+                          already in the store. The full history if not specified.
+        :param saveIndex: Set to False to leave writing the index to the caller.
+        """
+        queryStr = ('SELECT ' + ', '.join(columnNames) + ' FROM prices ' +
+                    'WHERE Ticker = ? ' +
+                    'AND Date >= ? ' +
+                    'ORDER BY Date')
+
+        old = None
+        if fromDay != None and self.index.get(ticker, {}).get('rows', 0) > 0:
+            old = self.column(ticker, 'Date')
+
+        if old is None:
+            fromDay = -2**62
+
+        r = executeQueryArray(dbCon, queryStr, (ticker, int(fromDay)), columnDtype)
+
+        tickerDir = os.path.join(self.storeDir, ticker)
+        if not os.path.isdir(tickerDir):
+            os.makedirs(tickerDir)
+
+        # Number of rows kept from the store, those before fromDay.
+        nKept = 0 if old is None else np.searchsorted(old, fromDay, side='left')
+
+        for name in columnNames:
+            if nKept > 0:
+                col = np.concatenate((self.column(ticker, name)[:nKept], r[name]))
+            else:
+                col = r[name]
+            saveArray(self.columnFile(ticker, name), col)
+
+        if nKept + len(r) > 0:
+            dates = self.column(ticker, 'Date')
+            self.index[ticker] = {'rows': len(dates), 'first': int(dates[0]), 'last': int(dates[-1])}
+        else:
+            self.index[ticker] = {'rows': 0, 'first': None, 'last': None}
+
+        if saveIndex:
+            self.saveIndex()
+
+    def build(self, dbCon, tickers=None, verbose=False):
+        """
+        Copy price histories from the database into the store.
+
+        :param dbCon:   Database connection.
+        :param tickers: The stocks to copy, all stocks in the prices table if not specified.
+        :param verbose: Set to True for more output.
+        """
+        if tickers == None:
+            r = executeQuery(dbCon, 'SELECT DISTINCT Ticker FROM prices')
+            tickers = [x[0] for x in r]
+
+        for ticker in tickers:
+            self.writeTicker(dbCon, ticker, saveIndex=False)
+            if verbose:
+                print '{:s}: {:d} rows'.format(ticker, self.index[ticker]['rows'])
+
+        self.saveIndex()
+
+    def column(self, ticker, name):
+        """
+        Get a read-only memory map of one column for a stock. Maps are reused
+        until the file is replaced.
+
+        :param ticker: The stock.
+        :param name:   The column, one of columnNames.
+
+        :return: The array, or None if the stock is not in the store.
+        """
+        fileName = self.columnFile(ticker, name)
+
+        try:
+            st = os.stat(fileName)
+        except OSError:
+            return None
+
+        ident = (st.st_ino, st.st_mtime, st.st_size)
+
+        key = (ticker, name)
+        if key in self.maps and self.maps[key][0] == ident:
+            return self.maps[key][1]
+
+        arr = np.load(fileName, mmap_mode='r')
+        self.maps[key] = (ident, arr)
+        return arr
+
+    def getRange(self, ticker, startDay, endDay, price='Close'):
+        """
+        Get the days and prices for a stock in a range of days. The arrays
+        returned are views of the memory mapped files, nothing is copied.
+
+        :param ticker:   The stock.
+        :param startDay: First day number, inclusive.
+        :param endDay:   Last day number, exclusive.
+        :param price:    Open, High, Low, Close (default), or Volume.
+
+        :return: Array of day numbers and array of prices, both empty if no data.
+        """
+        dates = self.column(ticker, 'Date')
+
+        if dates is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        i0 = np.searchsorted(dates, startDay, side='left')
+        i1 = np.searchsorted(dates, endDay, side='left')
+
+        return dates[i0:i1], self.column(ticker, price)[i0:i1]
+
+    def onInsert(self, dbCon, tableName, spans):
+        """
+        Insert hook, copies the days just written to the prices table into
+        the store, from the first day written for each stock.
+        """
+        if tableName != 'prices':
+            return
+
+        for ticker, (first, last) in spans.items():
+            self.writeTicker(dbCon, ticker, fromDay=first, saveIndex=False)
+
+        self.saveIndex()
+
+    def enableSync(self):
+        """
+        Update the store after each insertDataIntoDB on the prices table.
+        """
+        registerInsertHook(self.onInsert)
+
+    def disableSync(self):
+        removeInsertHook(self.onInsert)
+
+
+if __name__ == '__main__':
+
+    con = getManager(dbFileFull).writeConnection()
+
+    store = ColumnStore(storeDirDefault)
+
+    print 'Building column store in {:s} ...'.format(storeDirDefault)
+    store.build(con, verbose=True)
+    print 'done'
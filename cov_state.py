@@ -0,0 +1,336 @@
+"""
+Covariance and correlation of the daily log returns of a set of stocks,
+kept up to date as new prices arrive instead of being worked out again
+from the full history. The state is a set of running sums, saved next to
+the database, and each new day costs O(nC^2) to add.
+
+With a lookback the state covers only the most recent days. The returns
+for those days are kept so the oldest can be taken off the sums as new
+ones are added.
+
+Only days on which every stock in the set has a price are used, as for
+getPricesForGroup, and a return is from one such day to the next. So a
+stock that stops getting prices, e.g. when it is delisted or its fetches
+fail, holds the whole state back. advance lists such stocks in stalled,
+and they can be taken out with dropTickers.
+
+    state = RunningCovariance(tickers, lookback=250)
+    state.advance(con, startDay=dateToDay('2015/01/01'))
+    state.save()
+    state.enableSync()       # advance and save after each insertDataIntoDB
+
+Run as a script to build the state for all the companies in the database.
+"""
+
+import sys, os.path, sqlite3
+import numpy as np
+from db_conn import getManager
+from tr_utils import *
+
+##########################################
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+# Default file for the state, next to the database.
+stateFileDefault = dataDir + '/' + dbFile + '-cov.npz'
+
+# Days that other stocks may have prices beyond the last day added before
+# the stocks without them are taken to have stalled the state.
+maxLagDays = 7
+
+##########################################
+
+class RunningCovariance(object):
+    """
+    Running sums giving the covariance of daily log returns for a set of stocks.
+    """
+
+    def __init__(self, tickers, lookback=None, stateFile=stateFileDefault):
+        """
+        :param tickers:   The stocks.
+        :param lookback:  Number of most recent returns to cover, all of them if None.
+        :param stateFile: Where to save the state.
+        """
+        self.tickers = list(tickers)
+        self.lookback = lookback
+        self.stateFile = stateFile
+
+        nC = len(self.tickers)
+
+        self.n = 0
+        self.sumX = np.zeros(nC)
+        self.sumXX = np.zeros((nC, nC))
+
+        # Last day added and the closing prices on that day.
+        self.lastDay = None
+        self.lastPrices = None
+
+        # Ring buffer of the returns in the lookback window.
+        if lookback != None:
+            self.recent = np.zeros((lookback, nC))
+        else:
+            self.recent = np.zeros((0, nC))
+        self.head = 0
+        self.sinceRecompute = 0
+
+        # Stocks without prices holding the state back, see advance.
+        self.stalled = []
+        self.reported = []
+
+    def addReturns(self, r):
+        """
+        Add one day's returns to the sums, dropping the oldest day if the
+        lookback window is full.
+
+        :param r: Array of returns, one for each stock.
+        """
+        self.sumX += r
+        self.sumXX += np.outer(r, r)
+        self.n += 1
+
+        if self.lookback == None:
+            return
+
+        if self.n > self.lookback:
+            old = self.recent[self.head]
+            self.sumX -= old
+            self.sumXX -= np.outer(old, old)
+            self.n -= 1
+
+        self.recent[self.head] = r
+        self.head = (self.head + 1) % self.lookback
+
+        # Adding and taking off lets rounding errors build up, so start the
+        # sums again from the buffer once per window. This keeps the cost
+        # per day at O(nC^2) on average.
+        self.sinceRecompute += 1
+        if self.sinceRecompute >= self.lookback:
+            self.recompute()
+
+    def recompute(self):
+        """
+        Work out the sums again from the returns in the lookback window.
+        """
+        window = self.recent[:self.n]
+        self.sumX = window.sum(axis=0)
+        self.sumXX = np.dot(window.T, window)
+        self.sinceRecompute = 0
+
+    def addDay(self, day, prices):
+        """
+        Add a day on which every stock has a price.
+
+        :param day:    Day number.
+        :param prices: Closing prices, in the order of the tickers.
+        """
+        prices = np.asarray(prices, dtype=np.float)
+
+        if self.lastPrices is not None:
+            self.addReturns(np.log(prices / self.lastPrices))
+
+        self.lastDay = day
+        self.lastPrices = prices
+
+    def advance(self, dbCon, startDay=None):
+        """
+        Add the days in the database after the last one added. Only days up
+        to the latest day that every stock has reached are added, so a day
+        is not passed over because some stocks have not been loaded yet.
+
+        If, after that, other stocks have prices more than maxLagDays after
+        the last day added, the stocks with none are listed in stalled.
+
+        :param dbCon:    Database connection.
+        :param startDay: First day to use if nothing has been added yet.
+
+        :return: Number of days added.
+        """
+        fromDay = self.lastDay
+        if fromDay == None:
+            fromDay = startDay - 1 if startDay != None else -sys.maxint
+
+        queryStr = ('SELECT Ticker, Date, Close FROM prices ' +
+                    'WHERE Ticker IN (' + ', '.join(['?'] * len(self.tickers)) + ') ' +
+                    'AND Date > ?')
+        r = executeQuery2(dbCon, queryStr, tuple(self.tickers) + (fromDay,))
+
+        self.stalled = []
+
+        if len(r) == 0:
+            return 0
+
+        tickerRow = dict((t, n) for n, t in enumerate(self.tickers))
+
+        rowTickers, dates, closes = zip(*r)
+        rows = np.asarray([tickerRow[t] for t in rowTickers], dtype=np.int)
+        days, cols = np.unique(np.asarray(dates, dtype=np.int64), return_inverse=True)
+
+        nC = len(self.tickers)
+        have = np.zeros((nC, len(days)), dtype=np.bool)
+        have[rows, cols] = True
+        prices = np.zeros((nC, len(days)))
+        prices[rows, cols] = closes
+
+        # Latest day reached by every stock.
+        complete = []
+        if have.any(axis=1).all():
+            lastCol = (len(days) - 1 - np.argmax(have[:, ::-1], axis=1)).min()
+            complete = np.nonzero(have[:, :lastCol + 1].all(axis=0))[0]
+
+        for c in complete:
+            self.addDay(int(days[c]), prices[:, c])
+
+        # Days still to add, and the stocks with no prices on any of them.
+        pending = days > (fromDay if self.lastDay == None else self.lastDay)
+        if pending.any() and days[-1] - days[pending][0] >= maxLagDays:
+            behind = ~have[:, pending].any(axis=1)
+            self.stalled = [t for t, b in zip(self.tickers, behind) if b]
+
+        return len(complete)
+
+    def dropTickers(self, tickers):
+        """
+        Take stocks out of the state, e.g. those listed in stalled. The sums
+        for the others are over the same days, so are kept as they are.
+
+        :param tickers: The stocks to drop.
+        """
+        drop = set(tickers)
+        keep = np.asarray([t not in drop for t in self.tickers], dtype=np.bool)
+
+        self.tickers = [t for t, k in zip(self.tickers, keep) if k]
+        self.sumX = self.sumX[keep]
+        self.sumXX = self.sumXX[keep][:, keep]
+        if self.lastPrices is not None:
+            self.lastPrices = self.lastPrices[keep]
+        self.recent = self.recent[:, keep]
+
+        self.stalled = [t for t in self.stalled if t not in drop]
+
+    def covariance(self):
+        """
+        :return: nC x nC sample covariance matrix of daily log returns, None
+                 if fewer than two returns have been added.
+        """
+        if self.n < 2:
+            return None
+        mean = self.sumX / self.n
+        return (self.sumXX - self.n * np.outer(mean, mean)) / (self.n - 1)
+
+    def correlation(self):
+        """
+        :return: nC x nC correlation matrix of daily log returns, None if
+                 fewer than two returns have been added.
+        """
+        cov = self.covariance()
+        if cov is None:
+            return None
+        sd = np.sqrt(np.diag(cov))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return cov / np.outer(sd, sd)
+
+    def save(self, stateFile=None):
+        """
+        Write the state to a file.
+
+        :param stateFile: The file, the one given when created if not specified.
+        """
+        if stateFile == None:
+            stateFile = self.stateFile
+
+        np.savez(stateFile + '.tmp.npz',
+                 tickers=np.asarray(self.tickers, dtype=np.str_),
+                 lookback=-1 if self.lookback == None else self.lookback,
+                 n=self.n, sumX=self.sumX, sumXX=self.sumXX,
+                 lastDay=-sys.maxint if self.lastDay == None else self.lastDay,
+                 lastPrices=np.zeros(0) if self.lastPrices is None else self.lastPrices,
+                 recent=self.recent, head=self.head,
+                 sinceRecompute=self.sinceRecompute)
+        os.rename(stateFile + '.tmp.npz', stateFile)
+
+    @classmethod
+    def load(cls, stateFile=stateFileDefault):
+        """
+        Read a state written by save.
+
+        :param stateFile: The file.
+
+        :return: The RunningCovariance.
+        """
+        f = np.load(stateFile)
+
+        lookback = int(f['lookback'])
+        state = cls(f['tickers'].tolist(), lookback=None if lookback < 0 else lookback,
+                    stateFile=stateFile)
+
+        state.n = int(f['n'])
+        state.sumX = f['sumX']
+        state.sumXX = f['sumXX']
+        lastDay = int(f['lastDay'])
+        if lastDay != -sys.maxint:
+            state.lastDay = lastDay
+            state.lastPrices = f['lastPrices']
+        state.recent = f['recent']
+        state.head = int(f['head'])
+        state.sinceRecompute = int(f['sinceRecompute'])
+
+        return state
+
+    def onInsert(self, dbCon, tableName, spans):
+        """
+        Insert hook, adds any newly completed days and saves the state.
+        Reports the stocks holding the state back when they change.
+        """
+        if tableName != 'prices':
+            return
+
+        if not any(t in spans for t in self.tickers):
+            return
+
+        if self.advance(dbCon) > 0:
+            self.save()
+
+        if self.stalled != self.reported:
+            if len(self.stalled) > 0:
+                print ('RunningCovariance: held at {:s}, no later prices for {:s}. ' +
+                       'See dropTickers.').format(dayToDate(self.lastDay) if self.lastDay != None else 'start',
+                                                  ', '.join(self.stalled))
+            self.reported = list(self.stalled)
+
+    def enableSync(self):
+        """
+        Advance and save the state after each insertDataIntoDB on the prices table.
+        """
+        registerInsertHook(self.onInsert)
+
+    def disableSync(self):
+        removeInsertHook(self.onInsert)
+
+
+if __name__ == '__main__':
+
+    con = getManager(dbFileFull).writeConnection()
+
+    tickers = [x[0] for x in executeQuery(con, 'SELECT ticker FROM companies ' +
+                                               'WHERE ticker IN (SELECT DISTINCT Ticker FROM prices)')]
+
+    lookback = None
+    if len(sys.argv) > 1:
+        lookback = int(sys.argv[1])
+
+    state = RunningCovariance(tickers, lookback=lookback)
+    n = state.advance(con)
+
+    # Stocks that stopped getting prices would keep the state where it is.
+    if len(state.stalled) > 0:
+        print 'Dropping {:d} stocks without recent prices: {:s}'.format(len(state.stalled),
+                                                                         ', '.join(state.stalled))
+        state.dropTickers(state.stalled)
+        n += state.advance(con)
+
+    state.save()
+
+    print 'Added {:d} days for {:d} stocks, saved to {:s}'.format(n, len(state.tickers), stateFileDefault)
@@ -0,0 +1,174 @@
+"""
+Shared database connections. The database is put in WAL mode so that
+readers do not block the writer or each other. Each database gets a pool
+of read-only connections that can be used from worker threads, and a
+single writer connection used by one thread at a time. Nothing is opened
+until it is first needed.
+
+    manager = getManager(dbFileFull)
+
+    with manager.reader() as dbCon:
+        r = executeQuery(dbCon, 'SELECT ticker FROM companies')
+
+    with manager.writer() as dbCon:
+        insertDataIntoDB(dbCon, 'prices', data)
+
+Scripts that keep a module level connection can use a LazyConnection,
+which stands in for the writer connection and opens it on first use.
+"""
+
+import sqlite3, threading, Queue
+from contextlib import contextmanager
+
+##########################################
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+##########################################
+
+class ConnectionManager(object):
+    """
+    A pool of read-only connections and a single writer connection to
+    one database file.
+    """
+
+    def __init__(self, dbFileName, nReaders=4, timeout=30.0):
+        """
+        :param dbFileName: The sqlite database file.
+        :param nReaders:   Maximum number of read connections.
+        :param timeout:    Seconds to wait on a locked database before giving up.
+        """
+        self.dbFileName = dbFileName
+        self.nReaders = nReaders
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.writeLock = threading.RLock()
+
+        self.writeCon = None
+        self.readers = Queue.Queue()
+        self.nOpenReaders = 0
+
+    def openConnection(self, readOnly):
+        # Connections are handed between threads, the manager makes sure
+        # only one thread uses each at a time.
+        dbCon = sqlite3.connect(self.dbFileName, timeout=self.timeout,
+                                check_same_thread=False)
+        dbCon.execute('PRAGMA busy_timeout = {:d}'.format(int(self.timeout * 1000)))
+        if readOnly:
+            dbCon.execute('PRAGMA query_only = ON')
+        else:
+            dbCon.execute('PRAGMA journal_mode = WAL')
+            dbCon.execute('PRAGMA synchronous = NORMAL')
+        return dbCon
+
+    def writeConnection(self):
+        """
+        Get the writer connection, opening it if needed. Callers sharing it
+        between threads should use writer() instead.
+
+        :return: The connection.
+        """
+        with self.lock:
+            if self.writeCon == None:
+                self.writeCon = self.openConnection(readOnly=False)
+            return self.writeCon
+
+    @contextmanager
+    def writer(self):
+        """
+        Use the writer connection, waiting for any other thread using it to
+        finish. Changes are committed at the end of the block, or rolled
+        back if it raises.
+        """
+        with self.writeLock:
+            dbCon = self.writeConnection()
+            try:
+                yield dbCon
+            except:
+                dbCon.rollback()
+                raise
+            dbCon.commit()
+
+    @contextmanager
+    def reader(self):
+        """
+        Borrow a read-only connection from the pool, waiting for one to be
+        returned if all are in use.
+        """
+        # The writer switches the database to WAL mode, so make sure that
+        # has happened before the first reader opens.
+        self.writeConnection()
+
+        dbCon = None
+        try:
+            dbCon = self.readers.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                if self.nOpenReaders < self.nReaders:
+                    self.nOpenReaders += 1
+                    dbCon = self.openConnection(readOnly=True)
+
+        if dbCon == None:
+            dbCon = self.readers.get()
+
+        try:
+            yield dbCon
+        finally:
+            self.readers.put(dbCon)
+
+    def close(self):
+        """
+        Close the writer and any idle read connections.
+        """
+        with self.lock:
+            if self.writeCon != None:
+                self.writeCon.close()
+                self.writeCon = None
+
+            while True:
+                try:
+                    self.readers.get_nowait().close()
+                except Queue.Empty:
+                    break
+                self.nOpenReaders -= 1
+
+##########################################
+
+# One manager for each database file.
+managers = {}
+managersLock = threading.Lock()
+
+def getManager(dbFileName=dbFileFull, nReaders=4):
+    """
+    Get the connection manager for a database file, creating it if needed.
+
+    :param dbFileName: The sqlite database file.
+    :param nReaders:   Maximum number of read connections, if the manager is new.
+
+    :return: The ConnectionManager.
+    """
+    with managersLock:
+        if dbFileName not in managers:
+            managers[dbFileName] = ConnectionManager(dbFileName, nReaders=nReaders)
+        return managers[dbFileName]
+
+##########################################
+
+class LazyConnection(object):
+    """
+    Stands in for a sqlite3 connection to a database. The managed writer
+    connection is only opened when first used.
+    """
+
+    def __init__(self, dbFileName=dbFileFull):
+        """
+        :param dbFileName: The sqlite database file.
+        """
+        self.dbFileName = dbFileName
+
+    def __getattr__(self, name):
+        return getattr(getManager(self.dbFileName).writeConnection(), name)
@@ -3,9 +3,16 @@ Script can be used to populate prices data into a database that has previously
 been initialised but the init-db script.
 """
 
-import  urllib
+import  urllib, urllib2, urlparse
 import sqlite3
+from db_conn import LazyConnection
+import threading, Queue, socket, os.path
 from tr_utils import *
+from ingest import normalisePriceLines
+from col_store import ColumnStore
+from cov_state import RunningCovariance
+import sector_index
+import rollups
 import itertools
 
 ##########################################
@@ -21,14 +28,61 @@ dbFileFull = dataDir + '/' + dbFile + '.db'
 
 
 # Our database connection, later functions will rely on this.
-con = sqlite3.connect(dbFileFull)
+# Opened when first used, see db_conn.
+con = LazyConnection(dbFileFull)
+
+# The columnar copy of the prices and the running covariance of returns,
+# kept in sync with the database if they exist, see enableAutoRefresh.
+colStoreDir = dataDir + '/colstore'
+covStateFile = dataDir + '/' + dbFile + '-cov.npz'
+
+# Set once the insert hooks have been registered.
+autoRefreshEnabled = False
+
+# Where the historical prices are served from.
+priceURL = 'http://www.google.com/finance/historical'
+
+# Day numbers of the date strings seen in downloads, see normalisePriceLines.
+dateMemo = {}
+
+
+##########################################
+
+def enableAutoRefresh():
+    """
+    Keep everything made from the prices in data up to date as new prices
+    are inserted: the columnar copy and the running covariance, if they
+    have been saved, and the sector indices and weekly and monthly bars,
+    for databases that have them. The monthly counts of prices are kept up
+    to date by triggers, see price_coverage.
+
+    Called by initial_set_up and update, and by the ingest and archive
+    scripts. Nothing is registered on import, so other scripts using this
+    module do not write to these files.
+    """
+    global autoRefreshEnabled
+
+    if autoRefreshEnabled:
+        return
+
+    if os.path.isdir(colStoreDir):
+        ColumnStore(colStoreDir).enableSync()
+
+    if os.path.isfile(covStateFile):
+        RunningCovariance.load(covStateFile).enableSync()
+
+    sector_index.enableAutoRefresh()
+    rollups.enableAutoRefresh()
+
+    autoRefreshEnabled = True
 
 
 ##########################################
 
 def getPricesFromCSV(csvFile):
     """
-    Read price data from a csv file
+    Read price data from a csv file. For large files use
+    ingest.ingestPricesCSV, which streams the file into the database.
     :param csvFile:  THe file with the data. It is assumed to be in a fixed format (see below)
     :return: A list of prices, each element corresponds to a row of data.
     """
@@ -44,18 +98,21 @@ def getPricesFromCSV(csvFile):
 
 ##########################################
 
-def getPricesFromURL(ticker, start_date_str, end_date_str, verbose=False):
+def makePriceURL(ticker, start_date_str, end_date_str, baseURL=None):
     """
-    Get the price data from the google server for a given datae range.
+    Build the URL to request the price data for a stock over a date range.
 
     :param ticker: The stock's short name.
     :param start_date_str: Format YYYY-MM-DD
     :param end_date_str: As above
+    :param baseURL: Server to ask, the google server if not specified.
 
-    :return: list of tuples, each with a line of prices for the date interval
-    requested. Format is Date,Open,High,Low,Close,Volume.
+    :return: The URL string.
     """
 
+    if baseURL == None:
+        baseURL = priceURL
+
     y = int(start_date_str[0:4])
     m = int(start_date_str[5:7])
     d = int(start_date_str[8:10])
@@ -71,18 +128,25 @@ def getPricesFromURL(ticker, start_date_str, end_date_str, verbose=False):
 
     prefix = 'LON:'
 
-    url_string = ('http://www.google.com/finance/historical' +
+    url_string = (baseURL +
                   '?q={:s}{:s}'.format(prefix, ticker) +
-                  '&startdate={0}'.format(start_str) +
-                  '&enddate={0}'.format(end_str) +
+                  '&startdate={0}'.format(urllib.quote(start_str)) +
+                  '&enddate={0}'.format(urllib.quote(end_str)) +
                   '&output=csv' )
 
-    if verbose:
-        print 'Getting following URL: {:s}'.format(url_string)
+    return url_string
 
-    csv = urllib.urlopen(url_string)
-    csv_lines = csv.readlines()
 
+##########################################
+
+def splitPriceLines(csv_lines):
+    """
+    Split the lines of a downloaded csv file into fields.
+
+    :param csv_lines: List of lines, the first is a header.
+
+    :return: list of lists, one for each line after the header.
+    """
     for i, line in enumerate(csv_lines):
       csv_lines[i] = line.split(',')
 
@@ -90,26 +154,241 @@ def getPricesFromURL(ticker, start_date_str, end_date_str, verbose=False):
     return csv_lines[1:]
 
 
+##########################################
+
+def getPricesFromURL(ticker, start_date_str, end_date_str, verbose=False, baseURL=None):
+    """
+    Get the price data from the google server for a given datae range.
+
+    :param ticker: The stock's short name.
+    :param start_date_str: Format YYYY-MM-DD
+    :param end_date_str: As above
+    :param baseURL: Server to ask, the google server if not specified.
+
+    :return: list of tuples, each with a line of prices for the date interval
+    requested. Format is Date,Open,High,Low,Close,Volume.
+    """
+
+    return splitPriceLines(getPriceLinesFromURL(ticker, start_date_str, end_date_str,
+                                                verbose=verbose, baseURL=baseURL))
+
+
+##########################################
+
+def getPriceLinesFromURL(ticker, start_date_str, end_date_str, verbose=False, baseURL=None):
+    """
+    As getPricesFromURL, but return the lines of the csv file as they are.
+
+    :return: list of lines, the first is a header.
+    """
+
+    url_string = makePriceURL(ticker, start_date_str, end_date_str, baseURL=baseURL)
+
+    if verbose:
+        print 'Getting following URL: {:s}'.format(url_string)
+
+    csv = urllib.urlopen(url_string)
+    return csv.readlines()
+
+
+##########################################
+
+class RateLimiter(object):
+    """
+    Spread out requests so that no host gets more than a given number
+    of requests per second. Safe to share between threads.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: Maximum requests per second to any one host.
+        """
+        self.interval = 1.0 / rate
+        self.nextSlot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        """
+        Block until a request to the host is allowed.
+
+        :param host: The host name (and port) of the server.
+        """
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.nextSlot.get(host, now))
+            self.nextSlot[host] = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+##########################################
+
+def fetchWithRetry(url_string, limiter, retries=3, backoff=1.0, timeout=30):
+    """
+    Fetch a URL, respecting the rate limiter and retrying on failures that
+    may go away (time outs, connection errors, server errors and 429s).
+    The wait between attempts doubles each time.
+
+    :param url_string: The URL to fetch.
+    :param limiter:    A RateLimiter shared by all the workers.
+    :param retries:    Number of further attempts after the first one fails.
+    :param backoff:    Seconds to wait before the first retry.
+    :param timeout:    Socket time out in seconds.
+
+    :return: The lines of the response.
+    """
+    host = urlparse.urlparse(url_string).netloc
+
+    for attempt in range(retries + 1):
+        limiter.wait(host)
+        try:
+            f = urllib2.urlopen(url_string, timeout=timeout)
+            try:
+                return f.readlines()
+            finally:
+                f.close()
+        except urllib2.HTTPError as e:
+            # Client errors other than 'too many requests' will not go away.
+            if e.code < 500 and e.code != 429:
+                raise
+            err = e
+        except (urllib2.URLError, socket.error) as e:
+            err = e
+
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+
+    raise err
+
+
+##########################################
+
+def getPricesConcurrently(tickers, start_date_str, end_date_str, nWorkers=8,
+                          rate=2.0, retries=3, backoff=1.0, baseURL=None,
+                          dbCon=None, verbose=False):
+    """
+    Download the prices for a set of stocks using a pool of worker threads
+    and insert them into the database. The workers only fetch, the
+    calling thread is the single writer to the database.
+
+    :param tickers:        The short names of the stocks
+    :param start_date_str: Start of date range, format YYYY-MM-DD
+    :param end_date_str:   End of date range, as above.
+    :param nWorkers:       Number of fetching threads.
+    :param rate:           Maximum requests per second to each host.
+    :param retries:        Number of retries for each ticker.
+    :param backoff:        Seconds before the first retry, doubles each time.
+    :param baseURL:        Server to ask, the google server if not specified.
+    :param dbCon:          Database connection, module connection if not specified.
+    :param verbose:        Set to True for more output.
+
+    :return: List of the tickers that could not be fetched.
+    """
+
+    if dbCon == None:
+        dbCon = con
+
+    limiter = RateLimiter(rate)
+
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+
+    tickers = [t.upper() for t in tickers]
+    for ticker in tickers:
+        tasks.put(ticker)
+
+    def worker():
+        while True:
+            try:
+                ticker = tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            # Every ticker must put a result, the calling thread waits for
+            # one per ticker.
+            try:
+                url_string = makePriceURL(ticker, start_date_str, end_date_str, baseURL=baseURL)
+                if verbose:
+                    print 'Getting following URL: {:s}'.format(url_string)
+
+                lines = fetchWithRetry(url_string, limiter, retries=retries, backoff=backoff)
+                results.put((ticker, normalisePriceLines(lines[1:], dateMemo), None))
+            except Exception as e:
+                results.put((ticker, None, e))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(nWorkers, len(tickers)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    failed = []
+
+    for _ in range(len(tickers)):
+        ticker, data, err = results.get()
+
+        if err != None:
+            print '{:s}: Failed, {:s}'.format(ticker, str(err))
+            failed.append(ticker)
+            continue
+
+        columns, nRejected = data
+        storePriceColumns(dbCon, ticker, columns, nRejected)
+
+    for t in threads:
+        t.join()
+
+    return failed
+
+
+##########################################
+
+def storePriceColumns(dbCon, ticker, columns, nRejected):
+    """
+    Insert the prices for a stock made by normalisePriceLines into the
+    database, reporting what was obtained. Prices already in the database
+    are replaced by the ones downloaded if they differ, e.g. corrections.
+
+    :param dbCon:     Database connection.
+    :param ticker:    The stock.
+    :param columns:   Tuple of arrays (days, open, high, low, close, volume).
+    :param nRejected: Number of malformed rows dropped.
+    """
+    if nRejected > 0:
+        print '{:s}: Rejected {:d} malformed records'.format(ticker, nRejected)
+
+    if len(columns[0]) < 1:
+        print 'No data for ticker: {:s}'.format(ticker)
+        return
+
+    print '{:s}: Obtained {:d} records'.format(ticker, len(columns[0]))
+
+    counts = insertColumnsIntoDB(dbCon, 'prices', (ticker,) + tuple(columns), upsert=True)
+    if counts['updated'] > 0:
+        print '{:s}: Updated {:d} records'.format(ticker, counts['updated'])
+
+
 ##########################################
 
 def fixRawPriceData(data, ticker):
     """
-    Convert dates for all rows in the list of data and add in the
-    ticker name as a first element in each row. The data list is
-    modified in place.
+    Convert dates for all rows in the list of data to day numbers and add
+    in the ticker name as a first element in each row. The data list is
+    modified in place. The download functions use normalisePriceLines
+    instead, which also gives typed values and drops malformed rows.
 
     :param data:   A list of rows of prices data.
     :param ticker: The name of the stock to insert at the start of each row.
 
     """
     for i, row in enumerate(data):
-        row[0] = convertDateFormat(row[0])
+        row[0] = dateToDay(convertDateFormat(row[0]))
         data[i] = (ticker,) + tuple(row)
 
 
 ##########################################
 
-def getPricesSince(tickers, start_date_str, end_date_str=None):
+def getPricesSince(tickers, start_date_str, end_date_str=None, nWorkers=1):
     """
     Get the prices of a set of stocks since a given date and insert them into
     the database.
@@ -117,6 +396,7 @@ def getPricesSince(tickers, start_date_str, end_date_str=None):
     :param tickers:        The short names of the stocks
     :param start_date_str: Start of date range.
     :param end_date_str:   End of date range.
+    :param nWorkers:       Set above 1 to fetch concurrently, see getPricesConcurrently.
     """
 
     if end_date_str == None:
@@ -126,91 +406,87 @@ def getPricesSince(tickers, start_date_str, end_date_str=None):
     print start_date_str
     print end_date_str
 
+    if nWorkers > 1:
+        getPricesConcurrently(tickers, start_date_str, end_date_str, nWorkers=nWorkers)
+        print 'done'
+        return
+
     for ticker in tickers:
         ticker = ticker.upper()
 
-        data = getPricesFromURL(ticker, start_date_str, end_date_str)
+        lines = getPriceLinesFromURL(ticker, start_date_str, end_date_str)
 
-        if len(data) < 1:
-            print 'No data for ticker: {:s}'.format(ticker)
-            continue
-
-        print '{:s}: Obtained {:d} records'.format(ticker, len(data))
-
-        fixRawPriceData(data, ticker)
-        insertDataIntoDB(con, 'prices', data, verbose=False)
+        columns, nRejected = normalisePriceLines(lines[1:], dateMemo)
+        storePriceColumns(con, ticker, columns, nRejected)
 
     print 'done'
 
 ##########################################
 
-def updatePrices(tickers):
+def updatePrices(tickers, nWorkers=1):
     """
     Find most recent date for each stock in the set given.
     Retrieve data for that stock since that date and insert the
-    price data into the database.
+    price data into the database. Stocks that are already up to
+    date are not fetched, the others are fetched in batches that
+    share a start date. See planUpdates.
 
-    If no data exist in the database for a stock a default hard coded date is used. See below.
+    If no data exist in the database for a stock a default hard coded date is used. See planUpdates.
 
 
     :param tickers: The set of stocks to update.
+    :param nWorkers: Number of concurrent fetches, see getPricesSince.
     """
 
     end_date_str = datetime.date.today().isoformat()
 
-    for ticker in tickers:
-        ticker = ticker.upper()
-
-        queryStr = ('SELECT Date FROM prices '
-                    'WHERE ticker = ? '
-                    'ORDER BY Date DESC '
-                    'LIMIT 1')
-        pars = (ticker,)
-        r = executeQuery2(con, queryStr, pars)
-
-        if len(r) > 0:
-            start_date_str = str(r[0][0]).replace('/', '-')
-        else:
-            start_date_str = '2014-04-01'
-
-        if start_date_str >= end_date_str:
-            print '{:s} : Already up to date'.format(ticker)
+    plan, upToDate = planUpdates(con, tickers, end_date_str=end_date_str)
 
+    for ticker in upToDate:
+        print '{:s} : Already up to date'.format(ticker)
 
-        getPricesSince([ticker], start_date_str, end_date_str=end_date_str)
+    for start_date_str, group in plan:
+        getPricesSince(group, start_date_str, end_date_str=end_date_str, nWorkers=nWorkers)
 
 ##########################################
 
 
-def initial_set_up(dbCon):
+def initial_set_up(dbCon, nWorkers=8):
     """
     Call to get prices into an empty database. Dates are hard coded but can be changed.
 
     :param dbCon: A database connection.
+    :param nWorkers: Number of concurrent fetches.
 
     No return, just updates the database entries.
     """
     start_date_str = '2014-04-01'
     end_date_str = '2016-03-31'
 
+    enableAutoRefresh()
+
     tickers = executeQuery(dbCon, 'SELECT ticker FROM companies')
     tickers = list( itertools.chain(*tickers) )
-    getPricesSince(tickers, start_date_str, end_date_str=end_date_str)
+    getPricesSince(tickers, start_date_str, end_date_str=end_date_str, nWorkers=nWorkers)
 
 
 ##########################################
 
-def update():
+def update(nWorkers=1):
     """
     Go through the database, for each stock, identify the most recent
     date and get all prices since that date. Add them intto the database.
 
+    :param nWorkers: Number of concurrent fetches, see getPricesSince.
+
     No return, just updates the database entries.
     """
+    enableAutoRefresh()
+
     tickers = executeQuery(con, 'SELECT ticker FROM companies')
     tickers = list( itertools.chain(*tickers) )
 
-    updatePrices(tickers)
+    updatePrices(tickers, nWorkers=nWorkers)
 
 
 
@@ -0,0 +1,318 @@
+"""
+Streaming ingestion of csv files into the database. Files are read a
+fixed number of lines at a time, each chunk is parsed, its dates
+normalised and then inserted in its own transaction, so memory use does
+not grow with the size of the file.
+
+Run as a script to load a large archive of prices, e.g.
+
+    python ingest.py archive.csv
+    python ingest.py vod-history.csv VOD
+
+"""
+
+import sys, time, itertools, sqlite3
+import numpy as np
+from db_conn import getManager
+from tr_utils import *
+
+##########################################
+
+# To persuade sqlite to interpret numpy data types correctly.
+# http://stackoverflow.com/questions/11910584/sqlite3-writes-only-floating-point-numpy-arrays-not-integer-ones
+sqlite3.register_adapter(np.int64, int)
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+# Default number of csv lines handled at a time.
+chunkSizeDefault = 50000
+
+# Day number given to dates that cannot be parsed, see normaliseDates.
+badDay = np.iinfo(np.int64).min
+
+##########################################
+
+def tuneForBulkLoad(dbCon, journalMode='WAL', synchronous='NORMAL', cacheKB=65536):
+    """
+    Set the sqlite pragmas that matter for loading lots of rows.
+
+    :param dbCon:       Database connection.
+    :param journalMode: Journal mode, e.g. WAL, DELETE, MEMORY, or None to leave it.
+    :param synchronous: Synchronous level, e.g. OFF, NORMAL, FULL, or None to leave it.
+    :param cacheKB:     Size of the page cache in kilobytes, or None to leave it.
+    """
+    # Pragmas cannot change the journal mode inside a transaction.
+    dbCon.commit()
+
+    cur = dbCon.cursor()
+    if journalMode != None:
+        cur.execute('PRAGMA journal_mode = ' + journalMode)
+    if synchronous != None:
+        cur.execute('PRAGMA synchronous = ' + synchronous)
+    if cacheKB != None:
+        cur.execute('PRAGMA cache_size = -{:d}'.format(cacheKB))
+
+##########################################
+
+def readCSVChunks(csvFile, chunkSize=chunkSizeDefault, headerRows=1):
+    """
+    Read the lines of a csv file a chunk at a time.
+
+    :param csvFile:    The file.
+    :param chunkSize:  Maximum number of lines in each chunk.
+    :param headerRows: The number of header rows to skip.
+
+    :return: Generator giving lists of lines.
+    """
+    with open(csvFile) as f:
+        for _ in range(headerRows):
+            f.readline()
+
+        while True:
+            lines = list(itertools.islice(f, chunkSize))
+            if len(lines) == 0:
+                return
+            yield lines
+
+##########################################
+
+def parseCSVChunk(lines, fieldTypes):
+    """
+    Parse the lines of a chunk of a csv file into a structured array.
+
+    :param lines:      List of lines.
+    :param fieldTypes: The types of the columns, as for np.genfromtxt.
+
+    :return: Structured array, one element for each line.
+    """
+    return np.atleast_1d(np.genfromtxt(lines, delimiter=',', dtype=fieldTypes))
+
+##########################################
+
+def parseDateToDay(dateStr):
+    """
+    Convert a date in any of the formats seen in price files, DD-Mon-YY,
+    YYYY/MM/DD or YYYY-MM-DD, to a day number.
+
+    :param dateStr: Input date.
+    :return: Days since 1970/01/01.
+    """
+    dateStr = dateStr.strip()
+    if dateStr[4:5] in ('/', '-'):
+        return dateToDay(dateStr)
+    return dateToDay(convertDateFormat(dateStr))
+
+##########################################
+
+def normaliseDates(dateStrs, memo, strict=True):
+    """
+    Convert a column of dates to day numbers. Each distinct date string is
+    only parsed once, across all chunks sharing the memo.
+
+    :param dateStrs: Array of date strings.
+    :param memo:     Dictionary from date string to day number, updated.
+    :param strict:   Set to False to give badDay for dates that cannot be
+                     parsed, instead of raising an exception.
+
+    :return: Integer array of day numbers.
+    """
+    uniq, inv = np.unique(dateStrs, return_inverse=True)
+
+    days = np.zeros(len(uniq), dtype=np.int64)
+    for i, s in enumerate(uniq):
+        if s not in memo:
+            try:
+                memo[s] = parseDateToDay(s)
+            except ValueError:
+                if strict:
+                    raise
+                memo[s] = badDay
+        days[i] = memo[s]
+
+    return days[inv]
+
+##########################################
+
+def normalisePriceLines(lines, memo=None):
+    """
+    Turn the lines of a downloaded price file, Date,Open,High,Low,Close,Volume
+    without the header, into typed columns ready for insertColumnsIntoDB.
+
+    Rows without six fields, with a date that cannot be parsed, or with a
+    price or volume that is not a number (e.g. the '-' placeholders in
+    the google data) are dropped and counted.
+
+    :param lines: List of lines.
+    :param memo:  Dictionary from date string to day number, shared between
+                  calls so that each date is only parsed once.
+
+    :return: Tuple of arrays (days, open, high, low, close, volume).
+             Number of rows rejected.
+    """
+    if memo == None:
+        memo = {}
+
+    lines = np.char.strip(np.asarray(lines, dtype=np.str_))
+    lines = lines[np.char.str_len(lines) > 0]
+
+    if len(lines) == 0:
+        return emptyPriceColumns(), 0
+
+    wellFormed = np.char.count(lines, ',') == 5
+    lines = lines[wellFormed]
+    nRejected = int((~wellFormed).sum())
+
+    if len(lines) == 0:
+        return emptyPriceColumns(), nRejected
+
+    # Fields that are not numbers become NaN.
+    chunk = parseCSVChunk(lines.tolist(), 'S12,float,float,float,float,float')
+    names = chunk.dtype.names
+
+    days = normaliseDates(chunk[names[0]], memo, strict=False)
+    values = np.column_stack([chunk[name] for name in names[1:]])
+
+    valid = validPriceRows(days, values)
+    nRejected += int((~valid).sum())
+
+    return priceColumns(days[valid], values[valid]), nRejected
+
+##########################################
+
+def validPriceRows(days, values):
+    """
+    :param days:   Day numbers from normaliseDates with strict=False.
+    :param values: nR x 5 array of Open, High, Low, Close and Volume.
+
+    :return: Boolean array, True for the rows with a date and every value a number.
+    """
+    return (days != badDay) & np.isfinite(values).all(axis=1)
+
+##########################################
+
+def priceColumns(days, values):
+    """
+    :return: Tuple of arrays (days, open, high, low, close, volume) from the
+             day numbers and an nR x 5 array of the values.
+    """
+    return (days,
+            values[:, 0].copy(), values[:, 1].copy(), values[:, 2].copy(), values[:, 3].copy(),
+            np.rint(values[:, 4]).astype(np.int64))
+
+##########################################
+
+def emptyPriceColumns():
+    return (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0),
+            np.zeros(0, dtype=np.int64))
+
+##########################################
+
+def ingestPricesCSV(dbCon, csvFile, ticker=None, chunkSize=chunkSizeDefault,
+                    journalMode='WAL', synchronous='NORMAL', headerRows=1, verbose=True):
+    """
+    Load a csv file of prices into the prices table, a chunk at a time.
+
+    If a ticker is given the columns are Date,Open,High,Low,Close,Volume,
+    otherwise they are Ticker,Date,Open,High,Low,Close,Volume. Dates may be
+    in any of the formats accepted by parseDateToDay.
+
+    Rows with the wrong number of fields, no ticker, a date that cannot be
+    parsed, or a price or volume that is not a number are not loaded, as
+    for normalisePriceLines, and are counted.
+
+    Insert hooks are called once, after the last chunk, see deferInsertHooks.
+
+    :param dbCon:       Database connection.
+    :param csvFile:     The file with the data.
+    :param ticker:      The stock, if the file does not have a ticker column.
+    :param chunkSize:   Number of lines to insert in each transaction.
+    :param journalMode: Journal mode to use, see tuneForBulkLoad.
+    :param synchronous: Synchronous level to use, see tuneForBulkLoad.
+    :param headerRows:  The number of header rows in the file.
+    :param verbose:     Set to True to report progress after each chunk.
+
+    :return: Number of rows loaded, time taken in seconds, number of rows rejected.
+    """
+    # Fields that are not numbers become NaN.
+    fieldTypes = 'S12,S12,float,float,float,float,float'
+    nFields = 7
+    if ticker != None:
+        fieldTypes = fieldTypes[4:]
+        nFields = 6
+
+    tuneForBulkLoad(dbCon, journalMode=journalMode, synchronous=synchronous)
+
+    memo = {}
+    nRows = 0
+    nRejected = 0
+    t0 = time.time()
+
+    # Derived tables are refreshed once at the end, not after each chunk.
+    with deferInsertHooks(dbCon):
+        for lines in readCSVChunks(csvFile, chunkSize=chunkSize, headerRows=headerRows):
+            lines = np.char.strip(np.asarray(lines, dtype=np.str_))
+            lines = lines[np.char.str_len(lines) > 0]
+
+            wellFormed = np.char.count(lines, ',') == nFields - 1
+            nRejected += int((~wellFormed).sum())
+            lines = lines[wellFormed]
+
+            if len(lines) == 0:
+                continue
+
+            chunk = parseCSVChunk(lines.tolist(), fieldTypes)
+            cols = [chunk[name] for name in chunk.dtype.names]
+
+            if ticker != None:
+                tickerCol = ticker.upper()
+            else:
+                tickerCol = np.char.upper(np.char.strip(cols.pop(0)))
+
+            days = normaliseDates(cols[0], memo, strict=False)
+            values = np.column_stack(cols[1:])
+
+            valid = validPriceRows(days, values)
+            if ticker == None:
+                valid &= np.char.str_len(tickerCol) > 0
+                tickerCol = tickerCol[valid]
+            nRejected += int((~valid).sum())
+
+            if valid.any():
+                nRows += insertColumnsIntoDB(dbCon, 'prices',
+                                             (tickerCol,) + priceColumns(days[valid], values[valid]))
+
+            if verbose:
+                dt = time.time() - t0
+                print 'ingestPricesCSV: {:d} rows, {:.0f} rows/s, {:d} rejected'.format(
+                    nRows, nRows / max(dt, 1e-9), nRejected)
+
+    dt = time.time() - t0
+
+    if verbose:
+        print 'ingestPricesCSV: done, {:d} rows in {:.1f} s, {:d} rejected'.format(nRows, dt, nRejected)
+
+    return nRows, dt, nRejected
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print 'Usage: python ingest.py csvFile [ticker]'
+        sys.exit(1)
+
+    csvFile = sys.argv[1]
+    ticker = None
+    if len(sys.argv) > 2:
+        ticker = sys.argv[2]
+
+    con = getManager(dbFileFull).writeConnection()
+
+    # Keep the sector indices, bars and other tables made from the prices
+    # up to date, as for downloads.
+    import get_prices
+    get_prices.enableAutoRefresh()
+
+    ingestPricesCSV(con, csvFile, ticker=ticker)
@@ -7,8 +7,10 @@ and can be populated by the get_prices script.
 """
 
 import sqlite3
+from db_conn import LazyConnection
 import numpy as np
 import os.path, shutil
+from ingest import readCSVChunks, parseCSVChunk, tuneForBulkLoad
 
 #########################################################################
 
@@ -27,7 +29,8 @@ if os.path.isfile(dbFileFull):
     shutil.copy(dbFileFull, dataDir + '/' + dbFile + '-bak.db')
 
 # Our database connection, later functions will rely on this.
-con = sqlite3.connect(dbFileFull)
+# Opened when first used, see db_conn.
+con = LazyConnection(dbFileFull)
 
 #########################################################################
 
@@ -69,8 +72,10 @@ def createTable(tableName, fieldNames, pKey, clobber=False):
 #########################################################################
 
 def populateTableFromCSV(csvFile, tableName, fieldNames, fieldTypes, 
-                         clobber=False, verbose=False, headerRows=1):
+                         clobber=False, verbose=False, headerRows=1, chunkSize=50000):
     """
+    The csv file is read and inserted a chunk of lines at a time, so large
+    files can be loaded without holding them in memory.
 
     :param csvFile:    File with the data.
     :param tableName:  Table to insert the data into.
@@ -82,15 +87,10 @@ def populateTableFromCSV(csvFile, tableName, fieldNames, fieldTypes,
                        version of the table and create a new one. Default False.
     :param verbose:    Set to True to be more chatty (default = False).
     :param headerRows: The number of header rows in the csv file (derault = 1).
+    :param chunkSize:  Number of lines of the csv file to insert at a time.
     """
 
 
-    # Get the data from the csv file
-    dataToEnter = list(np.genfromtxt(csvFile,  delimiter=',', 
-                                     dtype=fieldTypes, 
-                                     skip_header=headerRows))
-
-
     # Check if the table already exists.
     checkCmd = ("SELECT name FROM sqlite_master " + 
     "WHERE type='table' AND name='" + tableName + "' ;")
@@ -118,8 +118,15 @@ def populateTableFromCSV(csvFile, tableName, fieldNames, fieldTypes,
     
         if verbose:
             print "populateTableFromCSV: ", cmd
-        cur.executemany(cmd, dataToEnter)
+
         con.commit()
+        tuneForBulkLoad(con)
+
+        # Get the data from the csv file
+        for lines in readCSVChunks(csvFile, chunkSize=chunkSize, headerRows=headerRows):
+            dataToEnter = parseCSVChunk(lines, fieldTypes)
+            cur.executemany(cmd, dataToEnter.tolist())
+            con.commit()
 
     else:
         
@@ -0,0 +1,100 @@
+"""
+Converts a database made by earlier versions of the scripts, where the
+dates in the prices table were stored as YYYY/MM/DD strings, so that the
+dates are stored as integer day numbers (days since 1970/01/01). See
+dateToDay and dayToDate in tr_utils.
+
+Safe to run more than once, rows that already have integer dates are left alone.
+
+"""
+
+import sqlite3
+import os.path, shutil
+
+#########################################################################
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+# Julian day number of 1970/01/01.
+epochJulianDay = 2440587.5
+
+#########################################################################
+
+def countTextDates(dbCon):
+    """
+    Count the rows in the prices table whose date is still a string.
+
+    :param dbCon: A database connection.
+    :return: The number of rows.
+    """
+    cur = dbCon.cursor()
+    cur.execute("SELECT COUNT(*) FROM prices WHERE typeof(Date) = 'text'")
+    return cur.fetchone()[0]
+
+#########################################################################
+
+def migratePriceDates(dbCon, verbose=True):
+    """
+    Convert YYYY/MM/DD (or YYYY-MM-DD) dates in the prices table to day
+    numbers. The conversion is done by sqlite in a single statement.
+
+    :param dbCon:   A database connection.
+    :param verbose: Set to True for more output.
+
+    :return: The number of rows converted.
+    """
+    nText = countTextDates(dbCon)
+
+    if verbose:
+        print 'migrate-db: {:d} rows with text dates.'.format(nText)
+
+    if nText == 0:
+        return 0
+
+    dayExpr = "julianday(replace(Date, '/', '-'))"
+
+    cmd = ("UPDATE OR REPLACE prices " +
+           "SET Date = CAST(" + dayExpr + " - {:.1f} AS INTEGER) ".format(epochJulianDay) +
+           "WHERE typeof(Date) = 'text' " +
+           "AND " + dayExpr + " IS NOT NULL")
+
+    if verbose:
+        print 'migrate-db: ', cmd
+
+    cur = dbCon.cursor()
+    cur.execute(cmd)
+    dbCon.commit()
+
+    # The rows REPLACE deleted did not fire the triggers on the prices
+    # table, so count the prices in price_coverage again.
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'price_coverage'")
+    if cur.fetchone()[0] > 0:
+        import price_coverage
+        price_coverage.refreshAll(dbCon, verbose=verbose)
+
+    nLeft = countTextDates(dbCon)
+
+    if nLeft > 0:
+        print 'migrate-db: {:d} rows have dates that could not be read.'.format(nLeft)
+
+    return nText - nLeft
+
+
+if __name__ == '__main__':
+
+    if not os.path.isfile(dbFileFull):
+        print 'No database found at {:s}'.format(dbFileFull)
+
+    else:
+        # Back up just in case.
+        shutil.copy(dbFileFull, dataDir + '/' + dbFile + '-premigrate.db')
+
+        con = sqlite3.connect(dbFileFull)
+
+        n = migratePriceDates(con)
+
+        print 'Converted {:d} rows.'.format(n)
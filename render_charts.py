@@ -0,0 +1,309 @@
+"""
+Batch rendering of price charts to image files, e.g. a nightly chart pack
+for every stock and sector. Charts are drawn without a display, by a pool
+of processes each with its own database connection, so the time taken is
+bounded by the number of cores.
+
+Long series are downsampled before drawing, keeping the shape of the
+series: either the lowest and highest point in each of a number of
+buckets (minmax), or the Largest Triangle Three Buckets method (lttb).
+
+    python render_charts.py charts 2010/01/01
+
+writes a png for every company and every sector into the charts directory.
+"""
+
+import sys, os, datetime, multiprocessing, sqlite3
+import numpy as np
+from tr_utils import executeQuery, executeQuery2, dateToDay, dayToDate
+
+##########################################
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+# Largest number of points drawn for a series.
+maxPointsDefault = 1000
+
+# Fewest points a series can be reduced to, the first and last and the
+# lowest and highest of one bucket.
+minPoints = 4
+
+##########################################
+
+def downsampleMinMax(x, y, nBuckets):
+    """
+    Reduce a series to the first and last points and the lowest and
+    highest points in each of nBuckets equal sized buckets. Peaks and
+    troughs are kept, so the chart looks the same at normal sizes.
+
+    :param x:        Array of x values, increasing.
+    :param y:        Array of y values.
+    :param nBuckets: Number of buckets.
+
+    :return: Arrays of x and y for the points kept, at most 2 * nBuckets + 2 long.
+    """
+    if nBuckets < 1:
+        raise Exception('downsampleMinMax: {:d} buckets, need at least 1.'.format(nBuckets))
+
+    n = len(y)
+    if n <= 2 * nBuckets + 2:
+        return x, y
+
+    size = int(np.ceil(n / float(nBuckets)))
+    nBuckets = int(np.ceil(n / float(size)))
+
+    # Pad with the last value so every bucket is full.
+    padded = np.empty(nBuckets * size)
+    padded[:n] = y
+    padded[n:] = y[-1]
+    buckets = padded.reshape(nBuckets, size)
+
+    offsets = np.arange(nBuckets) * size
+    iMin = np.minimum(offsets + buckets.argmin(axis=1), n - 1)
+    iMax = np.minimum(offsets + buckets.argmax(axis=1), n - 1)
+
+    keep = np.unique(np.concatenate(([0, n - 1], iMin, iMax)))
+    return x[keep], y[keep]
+
+##########################################
+
+def downsampleLTTB(x, y, nOut):
+    """
+    Reduce a series with the Largest Triangle Three Buckets method. The
+    first and last points are kept and from each bucket in between the
+    point making the largest triangle with the point kept from the
+    previous bucket and the mean of the next bucket.
+
+    :param x:    Array of x values, increasing.
+    :param y:    Array of y values.
+    :param nOut: Number of points to keep.
+
+    :return: Arrays of x and y for the points kept.
+    """
+    n = len(y)
+    if nOut >= n or nOut < 3:
+        return x, y
+
+    x = np.asarray(x, dtype=np.float)
+    y = np.asarray(y, dtype=np.float)
+
+    # Bucket edges for the points between the first and last.
+    edges = np.linspace(1, n - 1, nOut - 1).astype(np.int)
+
+    keep = np.zeros(nOut, dtype=np.int)
+    keep[-1] = n - 1
+
+    a = 0
+    for i in range(nOut - 2):
+        lo, hi = edges[i], edges[i + 1]
+
+        # Mean of the next bucket, or the last point for the final bucket.
+        if i < nOut - 3:
+            nlo, nhi = edges[i + 1], edges[i + 2]
+            cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + area.argmax()
+        keep[i + 1] = a
+
+    return x[keep], y[keep]
+
+##########################################
+
+downsamplers = {'minmax': lambda x, y, m: downsampleMinMax(x, y, m // 2 - 1),
+                'lttb': downsampleLTTB}
+
+##########################################
+
+def loadSeries(dbCon, kind, name, startDay, endDay, price='Close'):
+    """
+    Read the series to be drawn.
+
+    :param dbCon:    Database connection.
+    :param kind:     'ticker' for a stock or 'sector' for a sector index.
+    :param name:     The ticker or sector.
+    :param startDay: First day number, inclusive.
+    :param endDay:   Last day number, exclusive.
+    :param price:    Price field for stocks, capLevel or equalLevel for sectors.
+
+    :return: Array of day numbers and array of values.
+    """
+    if kind == 'ticker':
+        queryStr = ('SELECT Date, ' + price + ' FROM prices ' +
+                    'WHERE Ticker = ? AND Date >= ? AND Date < ? ORDER BY Date')
+    else:
+        if price not in ('capLevel', 'equalLevel'):
+            price = 'capLevel'
+        queryStr = ('SELECT Date, ' + price + ' FROM sector_index ' +
+                    'WHERE sector = ? AND Date >= ? AND Date < ? ORDER BY Date')
+
+    r = executeQuery2(dbCon, queryStr, (name, startDay, endDay))
+
+    days = np.asarray([x[0] for x in r], dtype=np.int64)
+    values = np.asarray([x[1] for x in r], dtype=np.float)
+    return days, values
+
+##########################################
+
+def drawChart(fileName, title, days, values):
+    """
+    Draw a series to an image file without using pyplot, so that no
+    display or global figure state is involved.
+
+    :param fileName: Output file, the format is taken from the extension.
+    :param title:    Title for the chart.
+    :param days:     Day numbers.
+    :param values:   Values to plot.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(8, 4.5))
+    FigureCanvasAgg(fig)
+
+    ax = fig.add_subplot(111)
+    dates = days.astype('datetime64[D]').astype(datetime.date)
+    ax.plot(dates, values, linewidth=0.8)
+    ax.set_title(title)
+    ax.grid(True, alpha=0.3)
+    fig.autofmt_xdate()
+
+    fig.savefig(fileName, dpi=100)
+
+##########################################
+
+# Each worker process has its own database connection.
+workerCon = None
+
+def initWorker(dbFileName):
+    global workerCon
+    workerCon = sqlite3.connect(dbFileName)
+    workerCon.execute('PRAGMA query_only = ON')
+
+##########################################
+
+def renderTask(task):
+    """
+    Draw one chart, run in a worker process.
+
+    :param task: Tuple of (kind, name, startDay, endDay, price, fileName, maxPoints, method).
+
+    :return: The file name, or None if there was no data.
+    """
+    kind, name, startDay, endDay, price, fileName, maxPoints, method = task
+
+    days, values = loadSeries(workerCon, kind, name, startDay, endDay, price)
+    if len(days) < 2:
+        return None
+
+    nPoints = len(days)
+    days, values = downsamplers[method](days, values, maxPoints)
+
+    title = '{:s}  {:s} to {:s}  ({:d} of {:d} points)'.format(
+        name, dayToDate(days[0]), dayToDate(days[-1]), len(days), nPoints)
+
+    drawChart(fileName, title, days, values)
+    return fileName
+
+##########################################
+
+def renderCharts(dbFileName, names, startDate, endDate=None, outDir='charts', kind='ticker',
+                 price='Close', fmt='png', maxPoints=maxPointsDefault, method='minmax',
+                 nWorkers=None, verbose=False):
+    """
+    Draw charts for a set of stocks or sectors using a pool of processes.
+
+    :param dbFileName: The sqlite database file.
+    :param names:      The tickers or sectors.
+    :param startDate:  Start date, inclusive.
+    :param endDate:    End date, exclusive, current date if not specified.
+    :param outDir:     Directory for the image files, created if needed.
+    :param kind:       'ticker' for stocks or 'sector' for sector indices.
+    :param price:      Price field for stocks, capLevel or equalLevel for sectors.
+    :param fmt:        Image format, e.g. png or svg.
+    :param maxPoints:  Largest number of points to draw for a series.
+    :param method:     Downsampling method, 'minmax' or 'lttb'.
+    :param nWorkers:   Number of processes, the number of cores if not specified.
+    :param verbose:    Set to True to print each file written.
+
+    :return: List of the files written.
+    """
+    if kind not in ('ticker', 'sector'):
+        raise Exception('renderCharts: {:s}, unknown kind.'.format(kind))
+    if method not in downsamplers:
+        raise Exception('renderCharts: {:s}, unknown method.'.format(method))
+    if maxPoints < minPoints:
+        raise Exception('renderCharts: maxPoints is {:d}, must be at least {:d}.'.format(maxPoints, minPoints))
+
+    # Check here rather than fail in every worker.
+    if not os.path.isfile(dbFileName):
+        raise Exception('renderCharts: {:s}, no such database.'.format(dbFileName))
+
+    con = sqlite3.connect(dbFileName)
+    try:
+        table = 'prices' if kind == 'ticker' else 'sector_index'
+        if len(executeQuery2(con, "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                             (table,))) == 0:
+            raise Exception('renderCharts: {:s} has no {:s} table.'.format(dbFileName, table))
+    finally:
+        con.close()
+
+    if endDate == None:
+        endDate = datetime.date.today().strftime('%Y/%m/%d')
+
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+
+    startDay = dateToDay(startDate)
+    endDay = dateToDay(endDate)
+
+    tasks = []
+    for name in names:
+        safeName = ''.join(c if c.isalnum() else '_' for c in name)
+        fileName = os.path.join(outDir, '{:s}-{:s}.{:s}'.format(kind, safeName, fmt))
+        tasks.append((kind, name, startDay, endDay, price, fileName, maxPoints, method))
+
+    if nWorkers == None:
+        nWorkers = multiprocessing.cpu_count()
+
+    pool = multiprocessing.Pool(nWorkers, initializer=initWorker, initargs=(dbFileName,))
+
+    written = []
+    try:
+        for fileName in pool.imap_unordered(renderTask, tasks):
+            if fileName != None:
+                written.append(fileName)
+                if verbose:
+                    print fileName
+    finally:
+        pool.close()
+        pool.join()
+
+    return written
+
+
+if __name__ == '__main__':
+
+    outDir = 'charts'
+    startDate = '2014/04/01'
+    if len(sys.argv) > 1:
+        outDir = sys.argv[1]
+    if len(sys.argv) > 2:
+        startDate = sys.argv[2]
+
+    con = sqlite3.connect(dbFileFull)
+    tickers = [x[0] for x in executeQuery(con, 'SELECT ticker FROM companies')]
+    sectors = [x[0] for x in executeQuery(con, 'SELECT DISTINCT sector FROM companies')]
+    con.close()
+
+    renderCharts(dbFileFull, tickers, startDate, outDir=outDir, verbose=True)
+
+    try:
+        renderCharts(dbFileFull, sectors, startDate, outDir=outDir, kind='sector', verbose=True)
+    except Exception as e:
+        print 'No sector charts: {:s}'.format(str(e))
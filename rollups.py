@@ -0,0 +1,291 @@
+"""
+Weekly and monthly OHLCV bars made from the daily prices, so that views
+over several years read hundreds of rows instead of thousands.
+
+Each bar has the Open of the first trading day in the period, the highest
+High, the lowest Low, the Close of the last trading day and the total
+Volume. Bars are keyed by the day number of the start of the period: the
+Monday for weekly bars, the first of the month for monthly bars.
+
+When new prices are inserted only the bars from the period of the first
+day written are worked out again, for each stock written. Call
+enableAutoRefresh to do this after each insertDataIntoDB.
+
+    days, closes, resolution = getRollupData(con, 'BP.', '2006/01/01', nPoints=200)
+
+Run as a script to create and fill the tables.
+"""
+
+import sqlite3, datetime
+import numpy as np
+from db_conn import getManager
+from tr_utils import *
+
+##########################################
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+# Julian day number of 1970/01/01.
+epochJulianDay = 2440587.5
+
+# For each resolution, the table and the SQL giving the day number of the
+# start of the period from a day number. Day 0, 1970/01/01, was a Thursday.
+rollupTables = {'week':  'prices_weekly',
+                'month': 'prices_monthly'}
+
+periodStartExpr = {'week':  '(Date - (Date + 3) % 7)',
+                   'month': ("CAST(julianday(Date * 86400, 'unixepoch', 'start of month') - " +
+                             str(epochJulianDay) + ' AS INTEGER)')}
+
+# Average number of trading days in each resolution, for choosing one.
+tradingDaysPer = {'day': 1.0, 'week': 5.0, 'month': 21.0}
+
+# Resolutions from finest to coarsest.
+resolutions = ('day', 'week', 'month')
+
+# How each field of a bar is made from the daily values in its period.
+barFields = {'Open':   lambda x: x[0],
+             'High':   np.max,
+             'Low':    np.min,
+             'Close':  lambda x: x[-1],
+             'Volume': np.sum}
+
+##########################################
+
+def periodStart(day, resolution):
+    """
+    Find the start of the week or month containing a day.
+
+    :param day:        Day number.
+    :param resolution: 'week' or 'month'.
+
+    :return: Day number of the Monday or the first of the month.
+    """
+    day = int(day)
+    if resolution == 'week':
+        return day - (day + 3) % 7
+    dd = epochDate + datetime.timedelta(day)
+    return (dd.replace(day=1) - epochDate).days
+
+##########################################
+
+def createRollupTables(dbCon, clobber=False):
+    """
+    Create the prices_weekly and prices_monthly tables.
+
+    :param dbCon:   Database connection.
+    :param clobber: Set to true to over write the tables.
+    """
+    cur = dbCon.cursor()
+    for tableName in rollupTables.values():
+        if clobber:
+            cur.execute('DROP TABLE IF EXISTS ' + tableName)
+
+        cur.execute('CREATE TABLE IF NOT EXISTS ' + tableName + '(' +
+                    'Ticker TEXT, ' +
+                    'Date INTEGER, ' +
+                    'Open FLOAT, ' +
+                    'High FLOAT, ' +
+                    'Low FLOAT, ' +
+                    'Close FLOAT, ' +
+                    'Volume INTEGER, ' +
+                    'nDays INTEGER, ' +
+                    'CONSTRAINT ' + tableName + '_pk PRIMARY KEY (Ticker, Date))')
+    dbCon.commit()
+
+##########################################
+
+def rollupSQL(resolution, where):
+    """
+    SQL to write the bars for the daily rows matching a condition. The
+    first Open and last Close are found with seeks on the prices primary
+    key from the first and last day of each period.
+
+    :param resolution: 'week' or 'month'.
+    :param where:      Condition on the prices table.
+    """
+    return ('INSERT OR REPLACE INTO ' + rollupTables[resolution] + ' ' +
+            'SELECT g.Ticker, g.period, o.Open, g.High, g.Low, c.Close, g.Volume, g.nDays ' +
+            'FROM (SELECT Ticker, ' + periodStartExpr[resolution] + ' AS period, ' +
+            'MIN(Date) AS firstDay, MAX(Date) AS lastDay, ' +
+            'MAX(High) AS High, MIN(Low) AS Low, SUM(Volume) AS Volume, COUNT(*) AS nDays ' +
+            'FROM prices WHERE ' + where + ' GROUP BY Ticker, period) g ' +
+            'JOIN prices o ON o.Ticker = g.Ticker AND o.Date = g.firstDay ' +
+            'JOIN prices c ON c.Ticker = g.Ticker AND c.Date = g.lastDay')
+
+##########################################
+
+def refreshTicker(dbCon, ticker, fromDay=None):
+    """
+    Work out the weekly and monthly bars of a stock again from the period
+    containing a given day onwards. Does not commit.
+
+    :param dbCon:   Database connection.
+    :param ticker:  The stock.
+    :param fromDay: Day number, all days if not specified.
+    """
+    cur = dbCon.cursor()
+    for resolution, tableName in rollupTables.items():
+        if fromDay == None:
+            start = -2**62
+        else:
+            start = periodStart(fromDay, resolution)
+
+        cur.execute('DELETE FROM ' + tableName + ' WHERE Ticker = ? AND Date >= ?', (ticker, start))
+        cur.execute(rollupSQL(resolution, 'Ticker = ? AND Date >= ?'), (ticker, start))
+
+##########################################
+
+def refreshAll(dbCon, verbose=False):
+    """
+    Work out all the bars from scratch, one statement for each table.
+
+    :param dbCon:   Database connection.
+    :param verbose: Set to True for more output.
+    """
+    cur = dbCon.cursor()
+    for resolution, tableName in rollupTables.items():
+        cur.execute('DELETE FROM ' + tableName)
+        cur.execute(rollupSQL(resolution, '1'))
+        if verbose:
+            print '{:s}: {:d} bars'.format(tableName, cur.rowcount)
+    dbCon.commit()
+
+    for tableName in rollupTables.values():
+        runInsertHooks(dbCon, tableName, None)
+
+##########################################
+
+def onPricesInserted(dbCon, table, spans):
+    """
+    Insert hook, refreshes the bars of the stocks written from the first
+    day written for each.
+    """
+    if table != 'prices':
+        return
+    for tableName in rollupTables.values():
+        if not tableExists(dbCon, tableName):
+            return
+
+    for ticker, (first, last) in spans.items():
+        refreshTicker(dbCon, ticker, first)
+    dbCon.commit()
+
+    # Let other hooks, e.g. the query cache, know the bars have changed.
+    for tableName in rollupTables.values():
+        runInsertHooks(dbCon, tableName, None)
+
+##########################################
+
+def enableAutoRefresh():
+    """
+    Refresh the bars after each insertDataIntoDB on the prices table. Does
+    nothing for databases without the rollup tables.
+    """
+    registerInsertHook(onPricesInserted)
+
+##########################################
+
+def disableAutoRefresh():
+    removeInsertHook(onPricesInserted)
+
+##########################################
+
+def chooseResolution(startDay, endDay, nPoints):
+    """
+    Choose the coarsest resolution that still gives at least a number of
+    points over a date range.
+
+    :param startDay: First day number.
+    :param endDay:   Last day number, exclusive.
+    :param nPoints:  Number of points wanted.
+
+    :return: 'day', 'week' or 'month'.
+    """
+    # Trading days in the range, five in every seven.
+    nDays = (endDay - startDay) * 5.0 / 7.0
+
+    for resolution in reversed(resolutions):
+        if nDays / tradingDaysPer[resolution] >= nPoints:
+            return resolution
+    return 'day'
+
+##########################################
+
+def getRollupData(dbCon, ticker, startDate, endDate=None, price='Close', nPoints=250):
+    """
+    Get price data for a stock at the coarsest resolution giving at least
+    nPoints points. Weekly and monthly bars cover whole periods, so the
+    first bar may start before startDate. The last bar, of the period
+    containing endDate, is made from the daily prices before endDate only,
+    so it never includes later prices.
+
+    :param dbCon:     Database connection
+    :param ticker:    The stock to look up
+    :param startDate: Start date, inclusive
+    :param endDate:   End date, exclusive, current date if not specified.
+    :param price:     Open, High, Low, Close (default) or Volume
+    :param nPoints:   Number of points wanted.
+
+    :return:          Array of days, each an offset from the first day found.
+                      Array of prices, same size as the array of days.
+                      The resolution used, 'day', 'week' or 'month'.
+                      None if no data found.
+    """
+    if endDate == None:
+        endDate = datetime.date.today().strftime('%Y/%m/%d')
+
+    startDay = dateToDay(startDate)
+    endDay = dateToDay(endDate)
+
+    resolution = chooseResolution(startDay, endDay, nPoints)
+
+    if resolution == 'day':
+        r = getTimeAndPriceData(dbCon, ticker, startDate, endDate, price)
+        if r == None:
+            return None
+        return r[0], r[1], resolution
+
+    if price not in barFields:
+        raise Exception('getRollupData: {:s}, unknown field.'.format(price))
+
+    dtype = [('Date', np.int64), ('price', np.float)]
+    lastStart = periodStart(endDay, resolution)
+
+    queryStr = ('SELECT Date, ' + price + ' FROM ' + rollupTables[resolution] + ' ' +
+                'WHERE Ticker = ? ' +
+                'AND Date >= ? ' +
+                'AND Date < ? ' +
+                'ORDER BY Date')
+    bars = executeQueryArray(dbCon, queryStr, (ticker, periodStart(startDay, resolution), lastStart),
+                             dtype)
+
+    # The stored bar of the last period may have prices from endDay on.
+    queryStr = ('SELECT Date, ' + price + ' FROM prices ' +
+                'WHERE Ticker = ? ' +
+                'AND Date >= ? ' +
+                'AND Date < ? ' +
+                'ORDER BY Date')
+    daily = executeQueryArray(dbCon, queryStr, (ticker, lastStart, endDay), dtype)
+
+    dates = bars['Date']
+    prices = bars['price']
+    if len(daily) > 0:
+        dates = np.append(dates, lastStart)
+        prices = np.append(prices, barFields[price](daily['price']))
+
+    if len(dates) < 1:
+        return None
+
+    return (dates - dates[0]).astype(np.float), prices, resolution
+
+
+if __name__ == '__main__':
+
+    con = getManager(dbFileFull).writeConnection()
+
+    createRollupTables(con)
+    refreshAll(con, verbose=True)
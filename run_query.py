@@ -9,9 +9,9 @@ Calls can be made at end of file.
 
 
 import sqlite3
+from db_conn import LazyConnection
 import numpy as np
 import itertools
-from sklearn.preprocessing import scale
 from tr_utils import *
 
 ##########################################
@@ -26,7 +26,18 @@ dbFile = 'trade_data'
 dbFileFull = dataDir + '/' + dbFile + '.db'
 
 # Our database connection, later functions will rely on this.
-con = sqlite3.connect(dbFileFull)
+# Opened when first used, see db_conn.
+con = LazyConnection(dbFileFull)
+
+##########################################
+
+def scale(x):
+    """
+    Scale to zero mean and unit variance. sklearn is only imported the
+    first time this is called.
+    """
+    from sklearn.preprocessing import scale as skScale
+    return skScale(x)
 
 ##########################################
 
@@ -59,12 +70,12 @@ def checkB():
 def checkC():
     s = ("SELECT Ticker, Date, Close FROM prices " +
          "WHERE Ticker = 'OML'" + " and " +
-         "Date >= '2016/01/11'")
-    # " and Date < '2016/04/10' "
+         "Date >= {:d}".format(dateToDay('2016/01/11')))
+    # " and Date < {:d}".format(dateToDay('2016/04/10'))
     r = executeQuery(con, s)
 
     for n, d, c in r:
-        print n, d, c
+        print n, dayToDate(d), c
 
 ##########################################
 def checkD():
@@ -96,11 +107,11 @@ def checkF():
                 'WHERE ticker = ? '
                 'AND Date > ? '
                 'ORDER BY Date DESC LIMIT 1')
-    pars = ('NXT','2016/01/01')
+    pars = ('NXT', dateToDay('2016/01/01'))
     r = executeQuery2(con, queryStr, pars)
     print len(r)
     for x in r:
-        print x
+        print dayToDate(x[0])
 
 
 ##########################################
@@ -113,7 +124,9 @@ def checkG():
     end_date_str = '2015/07/01'
 
 
-    daysCommon, pricesAll = getPricesForGroup(con, tickers, start_date_str, end_date_str)
+    daysCommon, pricesAll, tickersAll = getPricesForGroup(con, tickers, start_date_str, end_date_str)
+
+    plt = getPyplot()
 
     plt.hold(True)
 
@@ -123,6 +136,32 @@ def checkG():
     plt.show()
 
 
+##########################################
+def checkH():
+
+    # The cross section queries should seek on the Date index, not scan prices.
+    ensureDateIndex(con)
+
+    day = dateToDay('2016/03/01')
+    for queryStr, pars in [(crossSectionSQL(priceFields), (day,)),
+                           (crossSectionSQL(('Close',), nTickers=2), (day, 'BP.', 'VOD')),
+                           (crossSectionSQL(('Close',), nDates=5), (day - 7, day)),
+                           (recentDatesSQL, (day, 5))]:
+        plan = explainQueryPlan(con, queryStr, pars)
+        print queryStr
+        for step in plan:
+            print '   ', step
+
+        assert any(dateIndexName in step for step in plan)
+        assert not any(step.startswith('SCAN prices') for step in plan)
+
+    day, tickers, values = getCrossSection(con, '2016/03/01', fields=('Close', 'Volume'))
+    print dayToDate(day), len(tickers), values.shape
+
+    days, tickers, values = getCrossSections(con, '2016/03/01', 5)
+    print [dayToDate(d) for d in days], len(tickers), values.shape
+
+
 ##########################################
 
 # Uncomment for the required checks.
@@ -134,4 +173,5 @@ def checkG():
 # checkE()
 # checkF()
 # checkG()
+# checkH()
 
@@ -0,0 +1,211 @@
+"""
+Materialised daily index levels for each sector, so that a sector series
+is one indexed read instead of a read for every member stock.
+
+The sector_index table holds, for each sector and day, an equal weighted
+and a market cap weighted level. Each day's level is the previous level
+times one plus the average return of the members that have a price on
+that day, a member's return being from its previous price. Weights come
+from the marketCap field in the companies table. Levels start from 100.
+
+When new prices are inserted only the affected sectors are refreshed, and
+only from the first day written. Call enableAutoRefresh to do this after
+each insertDataIntoDB.
+
+Run as a script to create and fill the table.
+"""
+
+import sqlite3
+import numpy as np
+from db_conn import getManager
+from tr_utils import *
+
+##########################################
+
+# The name of the file containing the sqlite database.
+dataDir = 'data'
+dbFile = 'trade_data'
+dbFileFull = dataDir + '/' + dbFile + '.db'
+
+tableName = 'sector_index'
+
+# Level on the day before the first return.
+baseLevel = 100.0
+
+##########################################
+
+def createSectorIndexTable(dbCon, clobber=False):
+    """
+    Create the sector_index table.
+
+    :param dbCon:   Database connection.
+    :param clobber: Set to true to over write the table.
+    """
+    cur = dbCon.cursor()
+    if clobber:
+        cur.execute('DROP TABLE IF EXISTS ' + tableName)
+
+    cur.execute('CREATE TABLE IF NOT EXISTS ' + tableName + '(' +
+                'sector TEXT, ' +
+                'Date INTEGER, ' +
+                'equalLevel FLOAT, ' +
+                'capLevel FLOAT, ' +
+                'nMembers INTEGER, ' +
+                'CONSTRAINT ' + tableName + '_pk PRIMARY KEY (sector, Date))')
+    dbCon.commit()
+
+##########################################
+
+def refreshSector(dbCon, sector, fromDay=None):
+    """
+    Work out the levels of a sector index again from a given day onwards.
+
+    :param dbCon:   Database connection.
+    :param sector:  The sector, as in the companies table.
+    :param fromDay: First day number to redo, all days if not specified.
+
+    :return: Number of days written.
+    """
+    if fromDay == None:
+        fromDay = -2**62
+
+    # Levels the refresh carries on from.
+    r = executeQuery2(dbCon,
+                      'SELECT equalLevel, capLevel FROM ' + tableName + ' ' +
+                      'WHERE sector = ? AND Date < ? ' +
+                      'ORDER BY Date DESC LIMIT 1',
+                      (sector, fromDay))
+    if len(r) > 0:
+        equalBase, capBase = r[0]
+    else:
+        equalBase, capBase = baseLevel, baseLevel
+
+    # Each member's return from its previous price, found with a seek on
+    # the prices primary key, averaged over the members for each day.
+    queryStr = ('SELECT p.Date, ' +
+                'AVG(p.Close / q.Close - 1), ' +
+                'SUM((p.Close / q.Close - 1) * c.marketCap) / SUM(c.marketCap), ' +
+                'COUNT(*) ' +
+                'FROM companies c ' +
+                'JOIN prices p ON p.Ticker = c.ticker ' +
+                'JOIN prices q ON q.Ticker = p.Ticker AND q.Date = ' +
+                '(SELECT MAX(Date) FROM prices r WHERE r.Ticker = p.Ticker AND r.Date < p.Date) ' +
+                'WHERE c.sector = ? AND p.Date >= ? ' +
+                'GROUP BY p.Date ' +
+                'ORDER BY p.Date')
+    r = executeQuery2(dbCon, queryStr, (sector, fromDay))
+
+    cur = dbCon.cursor()
+    cur.execute('DELETE FROM ' + tableName + ' WHERE sector = ? AND Date >= ?', (sector, fromDay))
+
+    if len(r) == 0:
+        dbCon.commit()
+        return 0
+
+    days, equalRet, capRet, nMembers = zip(*r)
+
+    equalLevel = equalBase * np.cumprod(1 + np.asarray(equalRet, dtype=np.float))
+    capLevel = capBase * np.cumprod(1 + np.asarray(capRet, dtype=np.float))
+
+    data = zip([sector] * len(days), days, equalLevel.tolist(), capLevel.tolist(), nMembers)
+    insertDataIntoDB(dbCon, tableName, data)
+
+    return len(data)
+
+##########################################
+
+def refreshAll(dbCon, verbose=False):
+    """
+    Work out all the sector indices from scratch.
+
+    :param dbCon:   Database connection.
+    :param verbose: Set to True for more output.
+    """
+    sectors = [x[0] for x in executeQuery(dbCon, 'SELECT DISTINCT sector FROM companies')]
+    for sector in sectors:
+        n = refreshSector(dbCon, sector)
+        if verbose:
+            print '{:s}: {:d} days'.format(sector, n)
+
+##########################################
+
+def onPricesInserted(dbCon, table, spans):
+    """
+    Insert hook, refreshes the sectors of the stocks written from the
+    first day written for each.
+    """
+    if table != 'prices' or not tableExists(dbCon, tableName):
+        return
+
+    tickers = list(spans.keys())
+    r = executeQuery2(dbCon,
+                      'SELECT ticker, sector FROM companies WHERE ticker IN (' +
+                      ', '.join(['?'] * len(tickers)) + ')',
+                      tuple(tickers))
+
+    fromDays = {}
+    for ticker, sector in r:
+        first = spans[ticker][0]
+        if sector not in fromDays or first < fromDays[sector]:
+            fromDays[sector] = first
+
+    for sector, fromDay in fromDays.items():
+        refreshSector(dbCon, sector, fromDay)
+
+##########################################
+
+def enableAutoRefresh():
+    """
+    Refresh the sector indices after each insertDataIntoDB on the prices
+    table. Does nothing for databases without a sector_index table.
+    """
+    registerInsertHook(onPricesInserted)
+
+##########################################
+
+def disableAutoRefresh():
+    removeInsertHook(onPricesInserted)
+
+##########################################
+
+def getSectorIndex(dbCon, sector, startDate, endDate=None, weighting='cap'):
+    """
+    Get the daily levels of a sector index.
+
+    :param dbCon:     Database connection
+    :param sector:    The sector, as in the companies table.
+    :param startDate: Start date, inclusive
+    :param endDate:   End date, exclusive, current date if not specified.
+    :param weighting: 'cap' for market cap weighted (default) or 'equal'.
+
+    :return:          Array of days, each an offset from the first day found.
+                      Array of levels, same size as the array of days.
+                      None if no data found.
+    """
+    if endDate == None:
+        endDate = datetime.date.today().strftime('%Y/%m/%d')
+
+    column = {'cap': 'capLevel', 'equal': 'equalLevel'}[weighting]
+
+    queryStr = ('SELECT Date, ' + column + ' FROM ' + tableName + ' ' +
+                'WHERE sector = ? ' +
+                'AND Date >= ? ' +
+                'AND Date < ? ' +
+                'ORDER BY Date')
+    r = executeQuery2(dbCon, queryStr, (sector, dateToDay(startDate), dateToDay(endDate)))
+
+    if len(r) < 1:
+        return None
+
+    dates = np.asarray([x[0] for x in r], dtype=np.int64)
+    levels = np.asarray([x[1] for x in r])
+
+    return (dates - dates[0]).astype(np.float), levels
+
+
+if __name__ == '__main__':
+
+    con = getManager(dbFileFull).writeConnection()
+
+    createSectorIndexTable(con)
+    refreshAll(con, verbose=True)
@@ -0,0 +1,215 @@
+"""
+Parameter sweeps of the backtests in backtest.py over a process pool.
+
+The price matrix is copied once into shared memory before the pool is
+started, each worker process maps it as a numpy array, and the tasks sent
+to the workers are only the signal name and parameters. The statistics of
+each run are sent back as they finish and written to the sweep_results
+table in batches by the calling process, the only writer.
+
+    days, prices, tickers = getPricesForGroup(con, tickers, '2010/01/01', '2016/01/01')
+    grid = parameterGrid(fast=range(5, 50, 5), slow=range(50, 250, 10))
+    runId, n = runSweep(con, prices, 'crossover', grid, cost=0.001)
+
+    SELECT params, sharpe FROM sweep_results WHERE runId = ? ORDER BY sharpe DESC LIMIT 10
+"""
+
+import sys, time, json, itertools, multiprocessing
+import numpy as np
+import backtest
+from tr_utils import *
+
+##########################################
+
+resultsTable = 'sweep_results'
+
+# Statistics from backtest.summaryStats kept for each run, in table order.
+statNames = ('sharpe', 'annualReturn', 'annualVolatility', 'maxDrawdown',
+             'totalReturn', 'meanTurnover', 'hitRate')
+
+##########################################
+
+def createResultsTable(dbCon):
+    """
+    Create the sweep_results table if it is not there.
+
+    :param dbCon: Database connection.
+    """
+    cur = dbCon.cursor()
+    cur.execute('CREATE TABLE IF NOT EXISTS ' + resultsTable + '(' +
+                'runId INTEGER, ' +
+                'signal TEXT, ' +
+                'params TEXT, ' +
+                ''.join(name + ' FLOAT, ' for name in statNames) +
+                'seconds FLOAT, ' +
+                'CONSTRAINT ' + resultsTable + '_pk PRIMARY KEY (runId, params))')
+    dbCon.commit()
+
+##########################################
+
+def parameterGrid(keep=None, **ranges):
+    """
+    Every combination of a set of parameter values.
+
+    :param keep:   Optional function taking a dictionary of parameters and
+                   returning False for combinations to leave out, e.g.
+                   lambda p: p['fast'] < p['slow'].
+    :param ranges: Values to try for each parameter.
+
+    :return: List of dictionaries of parameters.
+    """
+    names = sorted(ranges)
+    grid = [dict(zip(names, values)) for values in itertools.product(*[ranges[n] for n in names])]
+    if keep != None:
+        grid = [p for p in grid if keep(p)]
+    return grid
+
+##########################################
+
+def sharedMatrix(a):
+    """
+    Copy an array of doubles into shared memory.
+
+    :param a: The array.
+
+    :return: The multiprocessing RawArray and the shape of the array.
+    """
+    a = np.ascontiguousarray(a, dtype=np.float)
+    raw = multiprocessing.RawArray('d', a.size)
+    np.frombuffer(raw, dtype=np.float)[:] = a.ravel()
+    return raw, a.shape
+
+##########################################
+
+# The price matrix in each worker process, a view of the shared memory.
+workerPrices = None
+
+def initWorker(raw, shape):
+    global workerPrices
+    workerPrices = np.frombuffer(raw, dtype=np.float).reshape(shape)
+
+##########################################
+
+def runTask(task):
+    """
+    Backtest one set of parameters, run in a worker process.
+
+    :param task: Tuple of (signalName, params, cost).
+
+    :return: Tuple of (signalName, params, stats, seconds).
+    """
+    signalName, params, cost = task
+
+    t0 = time.time()
+    signal = backtest.signals[signalName](workerPrices, **params)
+    stats = backtest.backtest(workerPrices, signal, cost=cost)['stats']
+    seconds = time.time() - t0
+
+    return signalName, params, [float(stats[name]) for name in statNames], seconds
+
+##########################################
+
+def nextRunId(dbCon):
+    r = executeQuery(dbCon, 'SELECT MAX(runId) FROM ' + resultsTable)
+    return 1 if r[0][0] == None else r[0][0] + 1
+
+##########################################
+
+def runSweep(dbCon, prices, signalName, grid, cost=0.0, nWorkers=None, runId=None,
+             batchSize=100, verbose=False):
+    """
+    Backtest a signal for every set of parameters in a grid, in parallel,
+    writing the statistics of each to the sweep_results table.
+
+    :param dbCon:      Database connection for the results.
+    :param prices:     nC x nD array of prices, e.g. from getPricesForGroup.
+    :param signalName: Key of backtest.signals.
+    :param grid:       List of dictionaries of parameters, e.g. from parameterGrid.
+    :param cost:       Cost of trading, see backtest.backtest.
+    :param nWorkers:   Number of processes, the number of cores if not specified.
+    :param runId:      Identifier of the sweep in the results table, one more
+                       than the largest so far if not specified.
+    :param batchSize:  Number of results written in each transaction.
+    :param verbose:    Set to True to report progress after each batch.
+
+    :return: The runId and the number of results written.
+    """
+    createResultsTable(dbCon)
+    if runId == None:
+        runId = nextRunId(dbCon)
+
+    if nWorkers == None:
+        nWorkers = multiprocessing.cpu_count()
+
+    raw, shape = sharedMatrix(prices)
+
+    tasks = [(signalName, params, cost) for params in grid]
+
+    # Enough tasks per message to keep the pool busy without long waits at the end.
+    chunkSize = max(1, len(tasks) // (nWorkers * 8))
+
+    pool = multiprocessing.Pool(nWorkers, initializer=initWorker, initargs=(raw, shape))
+
+    nDone = 0
+    batch = []
+    t0 = time.time()
+
+    try:
+        for name, params, stats, seconds in pool.imap_unordered(runTask, tasks, chunkSize):
+            batch.append(tuple([runId, name, json.dumps(params, sort_keys=True)] + stats + [seconds]))
+
+            if len(batch) >= batchSize:
+                insertDataIntoDB(dbCon, resultsTable, batch)
+                nDone += len(batch)
+                batch = []
+
+                if verbose:
+                    dt = time.time() - t0
+                    print 'runSweep: {:d} of {:d}, {:.1f} runs/s'.format(nDone, len(tasks), nDone / dt)
+    finally:
+        pool.close()
+        pool.join()
+
+    if len(batch) > 0:
+        insertDataIntoDB(dbCon, resultsTable, batch)
+        nDone += len(batch)
+
+    return runId, nDone
+
+
+if __name__ == '__main__':
+
+    from db_conn import getManager
+
+    dataDir = 'data'
+    dbFile = 'trade_data'
+    dbFileFull = dataDir + '/' + dbFile + '.db'
+
+    startDate = '2014/04/01'
+    endDate = datetime.date.today().strftime('%Y/%m/%d')
+    if len(sys.argv) > 1:
+        startDate = sys.argv[1]
+
+    manager = getManager(dbFileFull)
+
+    with manager.reader() as con:
+        tickers = [x[0] for x in executeQuery(con, 'SELECT ticker FROM companies')]
+        r = getPricesForGroup(con, tickers, startDate, endDate)
+
+    if r == None:
+        print 'No prices between {:s} and {:s}'.format(startDate, endDate)
+        sys.exit(1)
+
+    days, prices, tickers = r
+
+    grid = parameterGrid(keep=lambda p: p['fast'] < p['slow'],
+                         fast=range(5, 55, 5), slow=range(20, 260, 20))
+
+    with manager.writer() as con:
+        runId, n = runSweep(con, prices, 'crossover', grid, cost=0.001, verbose=True)
+
+        print 'Run {:d}, best of {:d}:'.format(runId, n)
+        for params, sharpe in executeQuery2(con, 'SELECT params, sharpe FROM ' + resultsTable + ' ' +
+                                                 'WHERE runId = ? ORDER BY sharpe DESC LIMIT 10',
+                                            (runId,)):
+            print '{:s}  {:.2f}'.format(params, sharpe)
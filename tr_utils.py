@@ -2,13 +2,197 @@
 A set of utility functions used by the other scripts.
 """
 
-import datetime, time
+import datetime, time, os
+import sys, re, threading, collections, contextlib, functools, heapq, json, itertools, inspect, sqlite3
 import numpy as np
-from matplotlib import pyplot as plt
 
 
 ##########################################
 
+# matplotlib is slow to import and needs a display, so it is only
+# imported when something is first plotted, see getPyplot. Set the
+# environment variable TR_HEADLESS=1, or call setHeadless, to plot with
+# a backend that does not need a display.
+plt = None
+headless = os.environ.get('TR_HEADLESS', '0') not in ('', '0')
+
+def setHeadless(flag=True):
+    """
+    Choose whether to plot without a display. Only has an effect if called
+    before anything is plotted.
+
+    :param flag: Set to True to use the non-interactive Agg backend.
+    """
+    global headless
+    headless = flag
+
+##########################################
+
+def getPyplot():
+    """
+    Import matplotlib.pyplot the first time it is needed.
+
+    :return: The pyplot module.
+    """
+    global plt
+
+    if plt == None:
+        import matplotlib
+        if headless:
+            matplotlib.use('Agg')
+        from matplotlib import pyplot
+        plt = pyplot
+
+    return plt
+
+##########################################
+
+# Optional cache of query results, see enableQueryCache.
+queryCache = None
+
+# Optional timing statistics, see enableInstrumentation.
+instrumentation = None
+
+##########################################
+
+class Instrumentation(object):
+    """
+    Call counts, wall time and row counts for the instrumented functions,
+    and the slowest queries run with their parameters.
+    """
+
+    def __init__(self, nSlowest=20):
+        """
+        :param nSlowest: Number of slowest queries to keep.
+        """
+        self.nSlowest = nSlowest
+        self.functions = {}
+        self.slowest = []
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, rows, query=None, pars=None):
+        """
+        Record one call of a function.
+
+        :param name:    Function name.
+        :param seconds: Wall time taken.
+        :param rows:    Rows returned or written.
+        :param query:   Query string, for the query functions.
+        :param pars:    Query parameters.
+        """
+        with self.lock:
+            stats = self.functions.get(name)
+            if stats == None:
+                stats = {'calls': 0, 'seconds': 0.0, 'maxSeconds': 0.0, 'rows': 0}
+                self.functions[name] = stats
+
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['rows'] += rows
+            if seconds > stats['maxSeconds']:
+                stats['maxSeconds'] = seconds
+
+            if query != None:
+                item = (seconds, name, query, pars, rows)
+                if len(self.slowest) < self.nSlowest:
+                    heapq.heappush(self.slowest, item)
+                elif seconds > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, item)
+
+    def summary(self):
+        """
+        :return: Dictionary with the statistics for each function and the slowest queries.
+        """
+        with self.lock:
+            functions = {}
+            for name, stats in self.functions.items():
+                stats = dict(stats)
+                stats['meanSeconds'] = stats['seconds'] / stats['calls']
+                functions[name] = stats
+
+            slowest = [{'seconds': t, 'function': name, 'query': q,
+                        'pars': [str(p) for p in pars], 'rows': rows}
+                       for t, name, q, pars, rows in sorted(self.slowest, reverse=True)]
+
+        return {'functions': functions, 'slowestQueries': slowest}
+
+    def dumpJSON(self, fileName):
+        """
+        Write the summary to a JSON file.
+
+        :param fileName: The file to write.
+        """
+        with open(fileName, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+
+##########################################
+
+def enableInstrumentation(nSlowest=20):
+    """
+    Start recording timing statistics for executeQuery, executeQuery2,
+    insertDataIntoDB, getTimeAndPriceData and getPricesForGroup. Times
+    include any calls made to the other instrumented functions.
+
+    :param nSlowest: Number of slowest queries to keep.
+
+    :return: The Instrumentation object, see summary and dumpJSON.
+    """
+    global instrumentation
+    instrumentation = Instrumentation(nSlowest=nSlowest)
+    return instrumentation
+
+##########################################
+
+def disableInstrumentation():
+    """
+    Stop recording timing statistics.
+    """
+    global instrumentation
+    instrumentation = None
+
+##########################################
+
+def instrumented(countRows, isQuery=False):
+    """
+    Decorator to record the time taken by a function when instrumentation
+    is enabled. When it is not, the only cost is one test per call.
+
+    :param countRows: Function taking (args, result), where args is a
+                      dictionary of the arguments by name, however they
+                      were passed, and returning the number of rows
+                      returned or written.
+    :param isQuery:   Set to True if the function has query and pars
+                      arguments, a query string and its parameters.
+    """
+    def decorate(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if instrumentation == None:
+                return func(*args, **kwargs)
+
+            t0 = time.time()
+            result = func(*args, **kwargs)
+            seconds = time.time() - t0
+
+            callArgs = inspect.getcallargs(func, *args, **kwargs)
+
+            query, pars = None, None
+            if isQuery:
+                query = callArgs['query']
+                pars = callArgs.get('pars', ())
+
+            instrumentation.record(name, seconds, countRows(callArgs, result), query, pars)
+            return result
+
+        return wrapper
+
+    return decorate
+
+##########################################
+
+@instrumented(lambda args, r: len(r), isQuery=True)
 def executeQuery(dbCon, query):
     """
     Run a specific query on the database and return the results.
@@ -19,6 +203,9 @@ def executeQuery(dbCon, query):
 
     :return: A tuple containing the results of running query.
     """
+    if queryCache != None:
+        return queryCache.execute(dbCon, query, ())
+
     cur = dbCon.cursor()
     cur.execute(query)
 
@@ -27,6 +214,7 @@ def executeQuery(dbCon, query):
 
 ##########################################
 
+@instrumented(lambda args, r: len(r), isQuery=True)
 def executeQuery2(dbCon, query, pars):
     """
     Run a specific query on the database and return the results.
@@ -43,6 +231,9 @@ def executeQuery2(dbCon, query, pars):
 
     :return: A tuple containing the results of running query.
     """
+    if queryCache != None:
+        return queryCache.execute(dbCon, query, pars)
+
     cur = dbCon.cursor()
     cur.execute(query, pars)
 
@@ -51,7 +242,398 @@ def executeQuery2(dbCon, query, pars):
 
 ##########################################
 
-def insertDataIntoDB(dbCon, tableName, data, verbose=False):
+@instrumented(lambda args, r: len(r), isQuery=True)
+def executeQueryArray(dbCon, query, pars, dtype, chunkSize=8192):
+    """
+    Run a query and return the results as a numpy structured array, with a
+    field for each column. Rows are fetched chunkSize at a time straight
+    into the array, which grows as needed, so the results never exist as
+    a full list of tuples as well.
+
+    E.g. executeQueryArray(con, 'SELECT Date, Close FROM prices WHERE Ticker = ?', ('BP.',),
+                           [('Date', np.int64), ('Close', np.float)])
+
+    :param dbCon:     Database connection.
+    :param query:     String with a query.
+    :param pars:      Parameters to substitute into the query.
+    :param dtype:     Type of the array, one field for each column selected.
+                      NULLs become NaN in float fields, and are an error in
+                      integer fields.
+    :param chunkSize: Number of rows fetched at a time.
+
+    :return: The structured array, one element for each row.
+    """
+    dtype = np.dtype(dtype)
+
+    if queryCache != None:
+        return np.array(queryCache.execute(dbCon, query, pars), dtype=dtype)
+
+    cur = dbCon.cursor()
+    cur.execute(query, pars)
+
+    out = np.zeros(chunkSize, dtype=dtype)
+    n = 0
+
+    while True:
+        rows = cur.fetchmany(chunkSize)
+        if len(rows) == 0:
+            break
+
+        if n + len(rows) > len(out):
+            out.resize(max(2 * len(out), n + len(rows)), refcheck=False)
+
+        out[n:n + len(rows)] = rows
+        n += len(rows)
+
+    out.resize(n, refcheck=False)
+    return out
+
+##########################################
+
+# Functions to call after data have been inserted, see registerInsertHook.
+insertHooks = []
+
+def registerInsertHook(func):
+    """
+    Register a function to be called each time insertDataIntoDB writes to
+    the database, e.g. to keep a derived copy of the data up to date.
+
+    The function is called as func(dbCon, tableName, spans). For the
+    prices table, spans is a dictionary mapping each ticker written to the
+    (first, last) day numbers of its rows. For other tables it is None.
+
+    :param func: The function to call.
+    """
+    if func not in insertHooks:
+        insertHooks.append(func)
+
+##########################################
+
+def removeInsertHook(func):
+    """
+    Stop calling a function registered with registerInsertHook.
+
+    :param func: The function to remove.
+    """
+    if func in insertHooks:
+        insertHooks.remove(func)
+
+##########################################
+
+def tickerSpans(data):
+    """
+    Find the range of days covered for each ticker in rows for the prices table.
+
+    :param data: Rows of prices data, each starting (Ticker, Date, ...).
+
+    :return: Dictionary mapping each ticker to its (first, last) day numbers.
+    """
+    spans = {}
+    for row in data:
+        ticker, day = row[0], row[1]
+        if ticker in spans:
+            lo, hi = spans[ticker]
+            spans[ticker] = (min(lo, day), max(hi, day))
+        else:
+            spans[ticker] = (day, day)
+    return spans
+
+##########################################
+
+def columnSpans(tickers, days):
+    """
+    Vectorised version of tickerSpans for prices data held as columns.
+
+    :param tickers: Array of tickers, one for each row, or a single ticker for all rows.
+    :param days:    Array of day numbers.
+
+    :return: Dictionary mapping each ticker to its (first, last) day numbers.
+    """
+    days = np.asarray(days, dtype=np.int64)
+    if len(days) == 0:
+        return {}
+
+    if isinstance(tickers, basestring):
+        return {tickers: (int(days.min()), int(days.max()))}
+
+    uniq, inv = np.unique(np.asarray(tickers), return_inverse=True)
+
+    lo = np.full(len(uniq), np.iinfo(np.int64).max, dtype=np.int64)
+    hi = np.full(len(uniq), np.iinfo(np.int64).min, dtype=np.int64)
+    np.minimum.at(lo, inv, days)
+    np.maximum.at(hi, inv, days)
+
+    return dict(zip(uniq.tolist(), zip(lo.tolist(), hi.tolist())))
+
+##########################################
+
+def runInsertHooks(dbCon, tableName, data, spans=None):
+    """
+    Call the registered insert hooks after rows have been written.
+
+    :param dbCon:     A database connection.
+    :param tableName: The table that was written to.
+    :param data:      The rows written.
+    :param spans:     For the prices table, the spans of the rows if already
+                      known, e.g. from columnSpans. Found from data if not.
+    """
+    if len(insertHooks) == 0:
+        return
+
+    if tableName == 'prices' and spans == None:
+        spans = tickerSpans(data)
+
+    if tableName == 'prices' and deferredSpans != None:
+        mergeSpans(deferredSpans, spans)
+        return
+
+    for func in list(insertHooks):
+        func(dbCon, tableName, spans)
+
+##########################################
+
+def mergeSpans(spans, more):
+    """
+    Widen the spans in a dictionary from tickerSpans to cover more spans, in place.
+    """
+    for ticker, (lo, hi) in more.items():
+        if ticker in spans:
+            spans[ticker] = (min(spans[ticker][0], lo), max(spans[ticker][1], hi))
+        else:
+            spans[ticker] = (lo, hi)
+
+##########################################
+
+# Spans of the prices written while the insert hooks are deferred, None
+# when they are not, see deferInsertHooks.
+deferredSpans = None
+
+@contextlib.contextmanager
+def deferInsertHooks(dbCon):
+    """
+    Context manager for bulk loads into the prices table. Inside it the
+    insert hooks are not called for the prices table; on leaving, even
+    after an exception, they are called once with the spans of all the
+    prices written, so each derived table is refreshed once for each
+    stock instead of once for each chunk. Hooks for other tables are
+    called as usual. Nested uses defer to the outermost one.
+
+        with deferInsertHooks(con):
+            for chunk in chunks:
+                insertColumnsIntoDB(con, 'prices', chunk)
+
+    :param dbCon: Database connection to call the hooks with.
+    """
+    global deferredSpans
+
+    if deferredSpans != None:
+        yield
+        return
+
+    deferredSpans = {}
+    try:
+        yield
+    finally:
+        spans, deferredSpans = deferredSpans, None
+        if len(spans) > 0:
+            runInsertHooks(dbCon, 'prices', None, spans=spans)
+
+##########################################
+
+class QueryCache(object):
+    """
+    Cache of the results of executeQuery and executeQuery2, keyed on the
+    connection, query string and parameters. The least recently used
+    results are dropped when the estimated size of the cache goes over a
+    limit. Results are invalidated when insertDataIntoDB writes to a table
+    the query reads from. Writes made by other processes, or not through
+    insertDataIntoDB, are not seen, call invalidateAll after those.
+    Queries on the schema tables are never cached, as tables are created
+    and dropped without passing through insertDataIntoDB.
+    """
+
+    # Table names following FROM or JOIN in a query.
+    tablePattern = re.compile(r'\b(?:FROM|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)', re.IGNORECASE)
+
+    # The tables sqlite keeps the schema in.
+    schemaPattern = re.compile(r'\bsqlite_(?:temp_)?(?:master|schema)\b', re.IGNORECASE)
+
+    def __init__(self, maxBytes=64 * 2**20):
+        """
+        :param maxBytes: Upper limit on the estimated size of the cached results.
+        """
+        self.maxBytes = maxBytes
+        self.nBytes = 0
+
+        # key -> (rows, tables, generations, size, dbCon). The connection is
+        # held so that its id, part of the key, cannot be reused.
+        self.entries = collections.OrderedDict()
+
+        # Table name -> count of writes to it.
+        self.generations = {}
+
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def tablesForQuery(self, query):
+        return tuple(sorted(set(t.lower() for t in self.tablePattern.findall(query))))
+
+    def execute(self, dbCon, query, pars):
+        """
+        Return the results of a query, from the cache if they are still valid.
+        """
+        firstWord = query.lstrip()[:6].upper()
+
+        if not (firstWord.startswith('SELECT') or firstWord.startswith('WITH')):
+            # Not a plain read, so could change any table.
+            cur = dbCon.cursor()
+            cur.execute(query, pars)
+            self.invalidateAll()
+            return cur.fetchall()
+
+        if self.schemaPattern.search(query) != None:
+            cur = dbCon.cursor()
+            cur.execute(query, pars)
+            return cur.fetchall()
+
+        key = (id(dbCon), query, tuple(pars))
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None:
+                rows, tables, gens = entry[0], entry[1], entry[2]
+                if gens == tuple(self.generations.get(t, 0) for t in tables):
+                    self.entries[key] = self.entries.pop(key)
+                    self.hits += 1
+                    return list(rows)
+
+                self.dropEntry(key)
+                self.invalidations += 1
+
+            self.misses += 1
+            tables = self.tablesForQuery(query)
+            gens = tuple(self.generations.get(t, 0) for t in tables)
+
+        cur = dbCon.cursor()
+        cur.execute(query, pars)
+        rows = cur.fetchall()
+
+        size = self.estimateSize(rows)
+        if size > self.maxBytes:
+            return rows
+
+        with self.lock:
+            # Results are only kept if no write happened while the query ran.
+            if gens == tuple(self.generations.get(t, 0) for t in tables):
+                if key in self.entries:
+                    self.dropEntry(key)
+                self.entries[key] = (rows, tables, gens, size, dbCon)
+                self.nBytes += size
+
+                while self.nBytes > self.maxBytes:
+                    self.dropEntry(next(iter(self.entries)))
+                    self.evictions += 1
+
+        return list(rows)
+
+    def estimateSize(self, rows):
+        """
+        Rough estimate of the memory used by a list of result rows.
+        """
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row)
+            for x in row:
+                size += sys.getsizeof(x)
+        return size
+
+    def dropEntry(self, key):
+        entry = self.entries.pop(key)
+        self.nBytes -= entry[3]
+
+    def invalidate(self, tableName):
+        """
+        Mark the results of queries reading from a table as out of date.
+
+        :param tableName: The table that has been written to.
+        """
+        with self.lock:
+            t = tableName.lower()
+            self.generations[t] = self.generations.get(t, 0) + 1
+
+    def invalidateAll(self):
+        """
+        Drop all cached results.
+        """
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.nBytes = 0
+
+    def onInsert(self, dbCon, tableName, spans):
+        """
+        Insert hook, invalidates results that depend on the table written.
+        """
+        self.invalidate(tableName)
+
+        # Written by triggers on the prices table.
+        if tableName == 'prices':
+            self.invalidate(coverageTable)
+
+    def stats(self):
+        """
+        :return: Dictionary with the hit and miss counts and the size of the cache.
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self.entries),
+                    'bytes': self.nBytes,
+                    'maxBytes': self.maxBytes}
+
+##########################################
+
+def enableQueryCache(maxBytes=64 * 2**20):
+    """
+    Start caching the results of executeQuery and executeQuery2. Useful
+    when the same queries are run again and again on data that change
+    rarely. Cached results are invalidated by insertDataIntoDB.
+
+    :param maxBytes: Upper limit on the estimated size of the cached results.
+
+    :return: The QueryCache, e.g. to look at its stats.
+    """
+    global queryCache
+
+    disableQueryCache()
+
+    queryCache = QueryCache(maxBytes=maxBytes)
+    registerInsertHook(queryCache.onInsert)
+
+    return queryCache
+
+##########################################
+
+def disableQueryCache():
+    """
+    Stop caching query results and drop any results held.
+    """
+    global queryCache
+
+    if queryCache != None:
+        removeInsertHook(queryCache.onInsert)
+        queryCache = None
+
+##########################################
+
+@instrumented(lambda args, r: len(args['data']))
+def insertDataIntoDB(dbCon, tableName, data, verbose=False, upsert=False):
     """
     Insert data into a specific table.
 
@@ -64,9 +646,80 @@ def insertDataIntoDB(dbCon, tableName, data, verbose=False):
 
     :param verbose: Set to True for more output.
 
+    :param upsert: Set to True to update rows already in the table with the
+                   new values, instead of leaving them as they are. See upsertRows.
+
+    :return: With upsert, the counts of rows inserted, updated and unchanged.
+
     """
     fieldCount = len(data[0])
 
+    checkTableExists(dbCon, tableName, 'insertDataIntoDB')
+
+    if upsert:
+        counts = upsertRows(dbCon, tableName, data, fieldCount, verbose=verbose)
+        if counts['inserted'] + counts['updated'] > 0:
+            runInsertHooks(dbCon, tableName, data)
+        return counts
+
+    cur = dbCon.cursor()
+
+    cmd = ('INSERT OR IGNORE INTO ' + tableName +
+           ' VALUES(' +
+           ', '.join(['?'] * fieldCount) +
+           ') ')
+
+    if verbose:
+        print "insertDataIntoDB:  ", cmd
+
+    cur.executemany(cmd, data)
+
+    dbCon.commit()
+
+    runInsertHooks(dbCon, tableName, data)
+
+##########################################
+
+# What is known of the schema seen by each connection, so that sqlite_master
+# is only read the first time a connection uses a table. Keyed on
+# id(dbCon), with the connection held in the entry, as in QueryCache, so
+# that the id cannot be reused by another connection. Entries are dropped
+# when the schema version changes, i.e. after any table is created,
+# dropped or altered, by this connection or any other.
+schemaCache = {}
+
+# Most connections kept in schemaCache before it is emptied.
+schemaCacheMax = 64
+
+def schemaEntry(dbCon):
+    """
+    :return: Dictionary with the set of tables known to exist ('tables')
+             and the columns of tables looked up ('columns') for a
+             connection, empty when the schema has changed.
+    """
+    cur = dbCon.cursor()
+    cur.execute('PRAGMA schema_version')
+    version = cur.fetchone()[0]
+
+    entry = schemaCache.get(id(dbCon))
+    if entry == None or entry[0] is not dbCon or entry[1] != version:
+        if entry == None and len(schemaCache) >= schemaCacheMax:
+            schemaCache.clear()
+        entry = (dbCon, version, {'tables': set(), 'columns': {}})
+        schemaCache[id(dbCon)] = entry
+
+    return entry[2]
+
+##########################################
+
+def tableExists(dbCon, tableName):
+    """
+    :return: True if a table is in the database.
+    """
+    known = schemaEntry(dbCon)['tables']
+    if tableName in known:
+        return True
+
     cur = dbCon.cursor()
 
     checkCmd = ("SELECT name FROM sqlite_master " +
@@ -76,20 +729,196 @@ def insertDataIntoDB(dbCon, tableName, data, verbose=False):
     nRows = len(cur.fetchall())
 
     if (nRows == 0):
-        raise Exception('insertDataIntoDB: {:s}, no such table.'.format(tableName))
+        return False
 
-    cmd = ('INSERT OR IGNORE INTO ' + tableName +
-           ' VALUES(' +
-           ', '.join(['?'] * fieldCount) +
-           ') ')
+    known.add(tableName)
+    return True
+
+##########################################
+
+def checkTableExists(dbCon, tableName, caller):
+    """
+    Raise an exception if a table is not in the database.
+
+    :param dbCon:     A database connection.
+    :param tableName: The table.
+    :param caller:    Name of the calling function, for the message.
+    """
+    if not tableExists(dbCon, tableName):
+        raise Exception('{:s}: {:s}, no such table.'.format(caller, tableName))
+
+##########################################
+
+def tableColumns(dbCon, tableName):
+    """
+    Look up the columns of a table.
+
+    :param dbCon:     A database connection.
+    :param tableName: The table.
+
+    :return: List of the column names, list of their declared types and
+             list of the primary key columns, in key order.
+    """
+    columns = schemaEntry(dbCon)['columns']
+    if tableName not in columns:
+        cur = dbCon.cursor()
+        cur.execute('PRAGMA table_info(' + tableName + ')')
+        r = cur.fetchall()
+
+        names = [x[1] for x in r]
+        types = [x[2] for x in r]
+        pk = [x[1] for x in sorted(r, key=lambda x: x[5]) if x[5] > 0]
+        columns[tableName] = (names, types, pk)
+
+    return columns[tableName]
+
+##########################################
+
+def upsertRows(dbCon, tableName, rows, fieldCount, verbose=False):
+    """
+    Insert rows into a table, updating those whose primary key is already
+    there. The rows are loaded into a temporary staging table, counted
+    against the table, and merged with a single INSERT ... ON CONFLICT DO
+    UPDATE (sqlite 3.24 or later). Rows whose values have not changed are
+    not written. Everything is one transaction.
+
+    If the same key appears more than once in the rows, the last one is used.
+
+    :param dbCon:      A database connection.
+    :param tableName:  The table.
+    :param rows:       Iterable of tuples, one element for each field in the table.
+    :param fieldCount: Number of elements in each tuple.
+    :param verbose:    Set to True for more output.
+
+    :return: Dictionary with the number of rows inserted, updated and unchanged.
+    """
+    names, types, pk = tableColumns(dbCon, tableName)
+
+    if len(pk) == 0:
+        raise Exception('upsertRows: {:s}, table has no primary key.'.format(tableName))
+    if fieldCount != len(names):
+        raise Exception('upsertRows: {:s}, {:d} fields given for {:d} columns.'.format(
+            tableName, fieldCount, len(names)))
+
+    staging = 'temp.staging_' + tableName
+    others = [n for n in names if n not in pk]
+
+    cur = dbCon.cursor()
+
+    # Declared with the same types as the table, so values compare the same way.
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS staging_' + tableName + '(' +
+                ', '.join(n + ' ' + t for n, t in zip(names, types)) + ', ' +
+                'PRIMARY KEY (' + ', '.join(pk) + '))')
+    cur.execute('DELETE FROM ' + staging)
+
+    cur.executemany('INSERT OR REPLACE INTO ' + staging +
+                    ' VALUES(' + ', '.join(['?'] * fieldCount) + ')', rows)
+
+    same = ' AND '.join('t.{0} IS s.{0}'.format(n) for n in others) or '1'
+    cur.execute('SELECT COUNT(*), COUNT(t.' + pk[0] + '), ' +
+                'TOTAL(t.' + pk[0] + ' IS NOT NULL AND ' + same + ') ' +
+                'FROM ' + staging + ' s LEFT JOIN ' + tableName + ' t ON ' +
+                ' AND '.join('t.{0} = s.{0}'.format(n) for n in pk))
+    nRows, nMatched, nSame = cur.fetchone()
+    nSame = int(nSame)
+
+    if len(others) > 0:
+        cmd = ('INSERT INTO ' + tableName + ' SELECT * FROM ' + staging + ' WHERE 1 ' +
+               'ON CONFLICT (' + ', '.join(pk) + ') DO UPDATE SET ' +
+               ', '.join('{0} = excluded.{0}'.format(n) for n in others) + ' ' +
+               'WHERE ' + ' OR '.join('{0}.{1} IS NOT excluded.{1}'.format(tableName, n) for n in others))
+    else:
+        cmd = 'INSERT OR IGNORE INTO ' + tableName + ' SELECT * FROM ' + staging
 
     if verbose:
-        print "insertDataIntoDB:  ", cmd
+        print "upsertRows:  ", cmd
 
-    cur.executemany(cmd, data)
+    cur.execute(cmd)
+    cur.execute('DELETE FROM ' + staging)
 
     dbCon.commit()
 
+    return {'inserted': nRows - nMatched,
+            'updated': nMatched - nSame,
+            'unchanged': nSame}
+
+##########################################
+
+@instrumented(lambda args, r: sum(r.values()) if isinstance(r, dict) else r)
+def insertColumnsIntoDB(dbCon, tableName, columns, spans=None, verbose=False, upsert=False):
+    """
+    Insert data held as columns into a specific table, without building a
+    list of tuples first. Rows are made one at a time as sqlite asks for them.
+
+    :param dbCon: A database connection.
+
+    :param tableName: The table into which the data should go
+
+    :param columns: One entry for each field in the table, in order. Each is
+                    an array (or list) with a value for every row, or a
+                    single value to use for all rows, e.g. the ticker.
+
+    :param spans: For the prices table, the spans of the rows for the insert
+                  hooks, see runInsertHooks. Found from the Ticker and Date
+                  columns if not given.
+
+    :param verbose: Set to True for more output.
+
+    :param upsert: Set to True to update rows already in the table with the
+                   new values, see upsertRows.
+
+    :return: The number of rows given, or with upsert the counts of rows
+             inserted, updated and unchanged.
+    """
+    lengths = [len(c) for c in columns if not isinstance(c, basestring) and np.ndim(c) > 0]
+    if len(lengths) == 0:
+        raise Exception('insertColumnsIntoDB: {:s}, no column arrays given.'.format(tableName))
+
+    nRows = lengths[0]
+    if any(n != nRows for n in lengths):
+        raise Exception('insertColumnsIntoDB: {:s}, columns differ in length.'.format(tableName))
+
+    if nRows == 0:
+        return {'inserted': 0, 'updated': 0, 'unchanged': 0} if upsert else 0
+
+    checkTableExists(dbCon, tableName, 'insertColumnsIntoDB')
+
+    # Plain python values from each column, which sqlite binds fastest.
+    iters = []
+    for c in columns:
+        if isinstance(c, basestring) or np.ndim(c) == 0:
+            iters.append(itertools.repeat(c, nRows))
+        elif isinstance(c, np.ndarray):
+            iters.append(c.tolist())
+        else:
+            iters.append(c)
+
+    if upsert:
+        result = upsertRows(dbCon, tableName, itertools.izip(*iters), len(columns), verbose=verbose)
+        if result['inserted'] + result['updated'] == 0:
+            return result
+    else:
+        cmd = ('INSERT OR IGNORE INTO ' + tableName +
+               ' VALUES(' +
+               ', '.join(['?'] * len(columns)) +
+               ') ')
+
+        if verbose:
+            print "insertColumnsIntoDB:  ", cmd
+
+        cur = dbCon.cursor()
+        cur.executemany(cmd, itertools.izip(*iters))
+
+        dbCon.commit()
+        result = nRows
+
+    if tableName == 'prices' and spans == None:
+        spans = columnSpans(columns[0], columns[1])
+
+    runInsertHooks(dbCon, tableName, None, spans=spans)
+
+    return result
+
 ##########################################
 
 def convertDateFormat(dateStr):
@@ -108,7 +937,40 @@ def convertDateFormat(dateStr):
 
 ##########################################
 
-def getTimeAndPriceData(dbCon, ticker, startDate, endDate=None, price='Close'):
+# Dates are stored in the prices table as integer day numbers, counted
+# from 1970/01/01 (epoch days), so range queries compare integers.
+epochDate = datetime.date(1970, 1, 1)
+
+def dateToDay(dateStr):
+    """
+    Convert a date in the format YYYY/MM/DD (or YYYY-MM-DD) to the day
+    number used in the database.
+
+    :param dateStr:  Input date.
+    :return:  Days since 1970/01/01.
+    """
+    y = int(dateStr[0:4])
+    m = int(dateStr[5:7])
+    d = int(dateStr[8:10])
+    return (datetime.date(y, m, d) - epochDate).days
+
+##########################################
+
+def dayToDate(day, sep='/'):
+    """
+    Convert a day number used in the database back into a date string.
+
+    :param day:  Days since 1970/01/01.
+    :param sep:  Separator between year, month and day.
+    :return:  Date in the format YYYY/MM/DD (with the given separator).
+    """
+    dd = epochDate + datetime.timedelta(int(day))
+    return dd.strftime('%Y' + sep + '%m' + sep + '%d')
+
+##########################################
+
+@instrumented(lambda args, r: 0 if r == None else len(r[0]))
+def getTimeAndPriceData(dbCon, ticker, startDate, endDate=None, price='Close', store=None):
     """
     Get price data stored in the database for a particular stock.
 
@@ -116,6 +978,10 @@ def getTimeAndPriceData(dbCon, ticker, startDate, endDate=None, price='Close'):
     :param ticker:    The stock to look up
     :param startDate: Start date, inclusive
     :param endDate:   End date, exclusive, current date if not specified.
+    :param price:     Open, High, Low, or Close (default)
+    :param store:     Optional ColumnStore (see col_store) to read from instead
+                      of the database. The prices returned are then a read-only
+                      view of the memory mapped file.
 
     :return:          Array of days, each represents an offsets from given start date.
                       Array of prices for each day in the date interval specfied.
@@ -126,28 +992,28 @@ def getTimeAndPriceData(dbCon, ticker, startDate, endDate=None, price='Close'):
     if endDate == None:
         endDate = datetime.date.today().strftime('%Y/%m/%d')
 
+    if store != None:
+        dates, prices = store.getRange(ticker, dateToDay(startDate), dateToDay(endDate), price)
+        if len(dates) < 1:
+            return None
+        return (dates - dates[0]).astype(np.float), prices
+
     queryStr = ('SELECT Date, '+ price + ' FROM prices ' +
                 'WHERE ticker = ? ' +
                 'AND Date >= ? ' +
-                'AND Date < ?')
-    pars = (ticker, startDate, endDate)
+                'AND Date < ? ' +
+                'ORDER BY Date')
+    pars = (ticker, dateToDay(startDate), dateToDay(endDate))
 
-    r = executeQuery2(dbCon, queryStr, pars)
+    r = executeQueryArray(dbCon, queryStr, pars, [('Date', np.int64), ('price', np.float)])
 
     if len(r) < 1:
         return None
 
+    prices = r['price']
+    dates = r['Date']
 
-    prices = np.asarray( [x[1] for x in r] )
-    dates = [x[0] for x in r]
-
-    x = datetime.datetime.strptime(dates[0], '%Y/%m/%d')
-
-    days = np.zeros(shape=(len(dates),))
-
-    for i, d in enumerate(dates):
-        y = datetime.datetime.strptime(d, '%Y/%m/%d')
-        days[i] = (y-x).days
+    days = (dates - dates[0]).astype(np.float)
 
     return days, prices
 
@@ -170,6 +1036,8 @@ def plotTimeAndPriceData(dbCon, ticker, startDate, endDate=None, price='Close'):
     if data == None:
         return
 
+    plt = getPyplot()
+
     days, prices = data
     plt.plot(days, prices)
     dlo = np.min(days)
@@ -181,12 +1049,222 @@ def plotTimeAndPriceData(dbCon, ticker, startDate, endDate=None, price='Close'):
     dhiStr = (x + datetime.timedelta(dhi)).strftime('%Y/%m/%d')
     plt.xticks([dlo, dhi], [dloStr, dhiStr], rotation=-45)
     plt.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.2)
-    plt.show()
+    if not headless:
+        plt.show()
+
+
+
+#########################################
+
+# Ways of lining up the days of a group of stocks, see alignGroup.
+alignModes = ('inner', 'outer', 'ffill')
+
+def alignGroup(rows, dates, prices, nC, mode='inner', minCoverage=0.9):
+    """
+    Line up the price series of a group of stocks on their days.
+
+    Stocks with prices on fewer than minCoverage times the number of days
+    of the best covered stock are dropped first. The days of the remaining
+    stocks are then merged into one sorted array and each price is placed
+    by a binary search into it, so the work is close to linear in the
+    number of prices.
+
+    :param rows:   Integer array giving the stock (0 to nC - 1) of each price.
+    :param dates:  Day numbers of the prices, increasing within each stock.
+    :param prices: The prices.
+    :param nC:     Number of stocks.
+    :param mode:   'inner' to keep only the days on which every stock has a price,
+                   'outer' to keep every day that any stock has a price, with NaN
+                   where a stock has none, or 'ffill' as for 'outer' but with each
+                   stock's last known price carried forward. Days before a stock's
+                   first price are still NaN.
+    :param minCoverage: Fraction of the best covered stock's days a stock needs to be kept.
+
+    :return: Array of day numbers of length nD.
+             nK x nD array of prices, one row for each stock kept.
+             Boolean array of length nC, True for the stocks kept.
+    """
+    if mode not in alignModes:
+        raise Exception('alignGroup: {:s}, unknown mode.'.format(mode))
+
+    rows = np.asarray(rows, dtype=np.int)
+    dates = np.asarray(dates, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float)
+
+    counts = np.bincount(rows, minlength=nC)
+    keep = (counts > 0) & (counts >= minCoverage * counts.max())
+    nK = keep.sum()
+
+    sel = keep[rows]
+    rows, dates, prices = rows[sel], dates[sel], prices[sel]
+
+    # Group by stock without upsetting the order of the days within each,
+    # and number the stocks kept from 0.
+    order = np.argsort(rows, kind='mergesort')
+    rows = (np.cumsum(keep) - 1)[rows[order]]
+    dates = dates[order]
+    prices = prices[order]
+
+    # Merge the sorted runs of days into one sorted array of distinct days.
+    allDays = np.sort(dates, kind='mergesort')
+    if len(allDays) > 0:
+        allDays = allDays[np.concatenate(([True], np.diff(allDays) > 0))]
+
+    cols = np.searchsorted(allDays, dates)
+
+    if mode == 'inner':
+        common = np.bincount(cols, minlength=len(allDays)) == nK
+        days = allDays[common]
+        # The prices on common days are in stock order, then day order.
+        return days, prices[common[cols]].reshape(nK, len(days)), keep
+
+    matrix = np.full((nK, len(allDays)), np.nan)
+    matrix[rows, cols] = prices
+
+    if mode == 'ffill':
+        have = np.zeros(matrix.shape, dtype=np.bool)
+        have[rows, cols] = True
+
+        # Index of the last day with a price, on or before each day. Where
+        # there is none this is 0, and the value there is NaN.
+        last = np.where(have, np.arange(len(allDays)), 0)
+        np.maximum.accumulate(last, axis=1, out=last)
+        matrix = matrix[np.arange(nK)[:, np.newaxis], last]
+
+    return allDays, matrix, keep
+
+
+#########################################
+
+# Number of prices of each stock in each month, and the triggers on the
+# prices table keeping it up to date, see the price_coverage module.
+coverageTable = 'price_coverage'
+coverageTriggers = ('price_coverage_insert', 'price_coverage_delete', 'price_coverage_update')
+
+def hasCoverage(dbCon):
+    """
+    :return: True if the database has the coverage table and the triggers
+             keeping it up to date. A table without them may be out of date.
+    """
+    known = schemaEntry(dbCon)
+    if 'coverage' not in known:
+        names = (coverageTable,) + coverageTriggers
+        cur = dbCon.cursor()
+        cur.execute('SELECT COUNT(*) FROM sqlite_master WHERE name IN (' +
+                    ', '.join(['?'] * len(names)) + ')', names)
+        known['coverage'] = cur.fetchone()[0] == len(names)
+    return known['coverage']
+
+def monthStart(day):
+    """
+    :return: Day number of the first of the month containing a day.
+    """
+    dd = epochDate + datetime.timedelta(int(day))
+    return (dd.replace(day=1) - epochDate).days
+
+#########################################
+
+def windowCounts(dbCon, tickers, startDay, endDay):
+    """
+    Count the prices of each of a set of stocks in a date interval, from
+    the coverage table for the whole months in the interval and from the
+    prices table for the part months at either end.
+
+    :param dbCon:    Database connection.
+    :param tickers:  The stocks.
+    :param startDay: First day number, inclusive.
+    :param endDay:   Last day number, exclusive.
+
+    :return: Integer array of counts, in the order of the tickers.
+    """
+    inList = 'Ticker IN (' + ', '.join(['?'] * len(tickers)) + ') '
+
+    fullStart = monthStart(startDay)
+    if fullStart < startDay:
+        fullStart = monthStart(fullStart + 31)
+    fullEnd = monthStart(endDay)
+
+    r = []
+    if fullStart < fullEnd:
+        r += executeQuery2(dbCon,
+                           'SELECT Ticker, SUM(nDays) FROM ' + coverageTable + ' ' +
+                           'WHERE ' + inList + 'AND month >= ? AND month < ? GROUP BY Ticker',
+                           tuple(tickers) + (fullStart, fullEnd))
+        ranges = [(startDay, fullStart), (fullEnd, endDay)]
+    else:
+        ranges = [(startDay, endDay)]
+
+    for lo, hi in ranges:
+        if lo < hi:
+            r += executeQuery2(dbCon,
+                               'SELECT Ticker, COUNT(*) FROM prices ' +
+                               'WHERE ' + inList + 'AND Date >= ? AND Date < ? GROUP BY Ticker',
+                               tuple(tickers) + (lo, hi))
+
+    tickerRow = dict((t, n) for n, t in enumerate(tickers))
+    counts = np.zeros(len(tickers), dtype=np.int64)
+    for ticker, n in r:
+        counts[tickerRow[ticker]] += n
+
+    return counts
+
+#########################################
+
+def commonSpan(dbCon, tickers, startDay, endDay):
+    """
+    Find the days in an interval between the latest first price and the
+    earliest last price of a set of stocks, outside which they cannot all
+    have prices. Two seeks on the prices primary key for each stock.
+
+    :return: First day number, inclusive, and last day number, exclusive.
+    """
+    queryStr = ('WITH t(Ticker) AS (VALUES ' + ', '.join(['(?)'] * len(tickers)) + ') ' +
+                'SELECT MAX((SELECT Date FROM prices p WHERE p.Ticker = t.Ticker AND p.Date >= ? ' +
+                'ORDER BY Date LIMIT 1)), ' +
+                'MIN((SELECT Date FROM prices p WHERE p.Ticker = t.Ticker AND p.Date < ? ' +
+                'ORDER BY Date DESC LIMIT 1)) ' +
+                'FROM t')
+    r = executeQuery2(dbCon, queryStr, tuple(tickers) + (startDay, endDay))
+
+    first, last = r[0]
+    if first == None or last == None or first > last:
+        return startDay, endDay
+    return max(first, startDay), min(last + 1, endDay)
+
+#########################################
+
+def readGroupRows(dbCon, tickerList, startDay, endDay, price='Close'):
+    """
+    Read the prices of a set of stocks in a date interval with one query.
+
+    :return: Arrays of the index of the stock in tickerList, the day and the
+             price of each row, ordered by stock then day. None if no data found.
+    """
+    queryStr = ('SELECT Ticker, Date, ' + price + ' FROM prices ' +
+                'WHERE Ticker IN (' + ', '.join(['?'] * len(tickerList)) + ') ' +
+                'AND Date >= ? ' +
+                'AND Date < ? ' +
+                'ORDER BY Ticker, Date')
+    pars = tuple(tickerList) + (startDay, endDay)
+
+    r = executeQueryArray(dbCon, queryStr, pars,
+                          [('Ticker', object), ('Date', np.int64), ('price', np.float)])
+
+    if len(r) < 1:
+        return None
+
+    # Rows are ordered by ticker, so each ticker is looked up once.
+    tickerRow = dict((t, n) for n, t in enumerate(tickerList))
+    uniq, inv = np.unique(r['Ticker'], return_inverse=True)
+    rows = np.asarray([tickerRow[t] for t in uniq], dtype=np.int)[inv]
 
+    return rows, r['Date'], r['price']
 
 
 #########################################
-def getPricesForGroup(dbCon, tickers, start_date_str, end_date_str):
+@instrumented(lambda args, r: 0 if r == None else r[1].size)
+def getPricesForGroup(dbCon, tickers, start_date_str, end_date_str, price='Close', store=None,
+                      mode='inner', minCoverage=0.9):
     """
     Get the closing prices for a set of stocks in a date interval.
     Some days in the interval may not have prices for all stocks.
@@ -195,12 +1273,28 @@ def getPricesForGroup(dbCon, tickers, start_date_str, end_date_str):
 
     Exclude stocks that have prices for fewer than 90% of days on which it is possible to have a price.
 
+    All the rows for the group are fetched with a single query ordered by
+    (Ticker, Date) and lined up by alignGroup, which can also keep the days
+    missing for some stocks (see mode).
+
+    If the database has the coverage table and its triggers (see the
+    price_coverage module) the stocks with too few prices are found from it
+    and not read at all and, for the common days only, neither are the days
+    before the last of the stocks starts or after the first one ends.
+
     Returns None if no data found.
 
     :param dbCon:     Database connection
     :param tickers:   The stocks to look up
     :param start_date_str: Start date, inclusive
     :param end_date_str:   End date, exclusive, current date if not specified.
+    :param price:     Open, High, Low, or Close (default)
+    :param store:     Optional ColumnStore (see col_store) to read from instead
+                      of the database.
+    :param mode:      'inner' (default) for the common days only, 'outer' for all
+                      days with NaN for missing prices, or 'ffill' for all days
+                      with missing prices filled from the last known one.
+    :param minCoverage: Fraction of days a stock needs prices on to be kept (default 0.9).
 
     :return:
     An array of days of length nD, where nD is the nubmer of days on which all stocks have price data.
@@ -208,49 +1302,329 @@ def getPricesForGroup(dbCon, tickers, start_date_str, end_date_str):
     A list of the stocks that have data for the interval.
     """
 
-    daysAll = []
-    pricesAll = []
-    tickersAll = []
+    if mode not in alignModes:
+        raise Exception('getPricesForGroup: {:s}, unknown mode.'.format(mode))
 
-    maxDayCount = 0
+    if end_date_str == None:
+        end_date_str = datetime.date.today().strftime('%Y/%m/%d')
 
+    # Keep the order in which the tickers were given, dropping repeats.
+    tickerRow = {}
+    tickerList = []
     for ticker in tickers:
-        data = getTimeAndPriceData(dbCon, ticker, start_date_str, endDate=end_date_str)
-        if data == None:
-            continue
-        days, prices = data
+        if ticker not in tickerRow:
+            tickerRow[ticker] = len(tickerList)
+            tickerList.append(ticker)
+
+    if len(tickerList) == 0:
+        return None
+
+    startDay = dateToDay(start_date_str)
+    endDay = dateToDay(end_date_str)
+
+    if store != None:
+        rows, dates, prices = [], [], []
+        for n, ticker in enumerate(tickerList):
+            d, p = store.getRange(ticker, startDay, endDay, price)
+            rows.append(np.zeros(len(d), dtype=np.int) + n)
+            dates.append(d)
+            prices.append(p)
+
+        rows = np.concatenate(rows)
+        dates = np.concatenate(dates)
+        prices = np.concatenate(prices).astype(np.float)
+
+        if len(rows) < 1:
+            # Have not found any data
+            return None
+
+    else:
+        readStart, readEnd = startDay, endDay
+
+        if hasCoverage(dbCon):
+            # The same rule as alignGroup, applied before reading.
+            counts = windowCounts(dbCon, tickerList, startDay, endDay)
+            kept = (counts > 0) & (counts >= minCoverage * counts.max())
+
+            tickerList = [t for t, k in zip(tickerList, kept) if k]
+            minCoverage = 0
+
+            if len(tickerList) == 0:
+                # Have not found any data
+                return None
+
+            if mode == 'inner':
+                readStart, readEnd = commonSpan(dbCon, tickerList, startDay, endDay)
+
+        r = readGroupRows(dbCon, tickerList, readStart, readEnd, price)
+
+        if r != None and (readStart, readEnd) != (startDay, endDay) and len(np.unique(r[0])) < len(tickerList):
+            # A stock has no prices in the common span, so there are no
+            # common days. Read the whole interval to give the same result
+            # as without the coverage table.
+            r = readGroupRows(dbCon, tickerList, startDay, endDay, price)
+
+        if r == None:
+            # Have not found any data
+            return None
+
+        rows, dates, prices = r
+
+    days, pricesAll, keep = alignGroup(rows, dates, prices, len(tickerList),
+                                       mode=mode, minCoverage=minCoverage)
+
+    tickersAll = [t for t, k in zip(tickerList, keep) if k]
+
+    # Days as offsets from the first one.
+    daysCommon = days
+    if len(days) > 0:
+        daysCommon = days - days[0]
+
+    return daysCommon, pricesAll, tickersAll
+
+
+#########################################
+
+# Secondary index on the prices table for reads of every stock on a day,
+# see ensureDateIndex. The primary key (Ticker, Date) cannot help there.
+dateIndexName = 'prices_date_idx'
+
+# Fields of the prices table that can be read as a cross section.
+priceFields = ('Open', 'High', 'Low', 'Close', 'Volume')
+
+def ensureDateIndex(dbCon):
+    """
+    Create the index on the Date column of the prices table if it is not
+    there yet. On a read only connection a missing index is left missing,
+    the queries then still work but scan the table.
+
+    :param dbCon: Database connection.
+
+    :return: True if the index is there.
+    """
+    known = schemaEntry(dbCon)
+    if known.get('dateIndex'):
+        return True
+
+    cur = dbCon.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?", (dateIndexName,))
+    if len(cur.fetchall()) == 0:
+        try:
+            cur.execute('CREATE INDEX IF NOT EXISTS ' + dateIndexName + ' ON prices(Date)')
+            dbCon.commit()
+        except sqlite3.OperationalError:
+            return False
+
+        # Creating the index changed the schema version.
+        known = schemaEntry(dbCon)
+
+    known['dateIndex'] = True
+    return True
+
+##########################################
+
+def explainQueryPlan(dbCon, query, pars=()):
+    """
+    Ask sqlite how it will run a query.
+
+    :param dbCon: Database connection.
+    :param query: String with a query.
+    :param pars:  Parameters to substitute into the query.
+
+    :return: List of the steps of the plan, e.g. 'SEARCH prices USING INDEX ...'.
+    """
+    cur = dbCon.cursor()
+    cur.execute('EXPLAIN QUERY PLAN ' + query, pars)
+    return [row[-1] for row in cur.fetchall()]
+
+##########################################
+
+def crossSectionSQL(fields, nTickers=0, nDates=1):
+    """
+    SQL for the prices of every stock (or nTickers of them) on one day, the
+    last with prices on or before a given day, or on the days in a range.
 
-        daysAll.append(days)
-        pricesAll.append(prices)
-        tickersAll.append(ticker)
+    :param fields:   Fields of the prices table to read.
+    :param nTickers: Number of tickers to restrict to, 0 for all stocks.
+    :param nDates:   1 for a single day, the query taking (day, tickers...),
+                     otherwise a range of days, taking (firstDay, lastDay, tickers...).
+    """
+    for field in fields:
+        if field not in priceFields:
+            raise Exception('crossSectionSQL: {:s}, unknown field.'.format(field))
+
+    queryStr = 'SELECT Ticker, Date, ' + ', '.join(fields) + ' FROM prices '
+
+    if nDates == 1:
+        queryStr += ('WHERE Date = ' +
+                     '(SELECT Date FROM prices WHERE Date <= ? ORDER BY Date DESC LIMIT 1) ')
+    else:
+        queryStr += 'WHERE Date >= ? AND Date <= ? '
+
+    if nTickers > 0:
+        queryStr += 'AND Ticker IN (' + ', '.join(['?'] * nTickers) + ') '
+
+    return queryStr
+
+##########################################
+
+def crossSectionDtype(fields):
+    """
+    :return: Type of the structured array read by the query from crossSectionSQL.
+    """
+    return [('Ticker', object), ('Date', np.int64)] + [(field, np.float) for field in fields]
+
+##########################################
+
+# The last nDates days with prices, on or before a given day. A walk back
+# along the Date index, stopping after nDates distinct days.
+recentDatesSQL = ('SELECT DISTINCT Date FROM prices WHERE Date <= ? ' +
+                  'ORDER BY Date DESC LIMIT ?')
+
+##########################################
+
+@instrumented(lambda args, r: 0 if r == None else r[2].size)
+def getCrossSection(dbCon, date, fields=priceFields, tickers=None):
+    """
+    Get the prices of every stock on a day. If there are no prices on
+    that day those of the last day before it with prices are given.
+
+    :param dbCon:   Database connection
+    :param date:    The date, YYYY/MM/DD.
+    :param fields:  Fields to read, any of Open, High, Low, Close and Volume.
+    :param tickers: Optional list of stocks to restrict to.
+
+    :return:        The day number of the prices.
+                    List of the nT stocks with prices on the day, sorted.
+                    nT x nF array of the values of the fields for each stock.
+                    None if no data found.
+    """
+    ensureDateIndex(dbCon)
+
+    tickers = [] if tickers == None else list(tickers)
+    queryStr = crossSectionSQL(fields, len(tickers)) + 'ORDER BY Ticker'
+
+    r = executeQueryArray(dbCon, queryStr, (dateToDay(date),) + tuple(tickers),
+                          crossSectionDtype(fields))
+
+    if len(r) < 1:
+        return None
+
+    values = np.column_stack([r[field] for field in fields])
+
+    return int(r['Date'][0]), r['Ticker'].tolist(), values
+
+##########################################
 
-        if len(days) > maxDayCount:
-            maxDayCount = len(days)
+@instrumented(lambda args, r: 0 if r == None else r[2].size)
+def getCrossSections(dbCon, endDate, nDates, fields=priceFields, tickers=None):
+    """
+    Get the prices of every stock on the last nDates days with prices, up
+    to and including a given date.
+
+    :param dbCon:   Database connection
+    :param endDate: The last date, inclusive, YYYY/MM/DD.
+    :param nDates:  Number of days.
+    :param fields:  Fields to read, any of Open, High, Low, Close and Volume.
+    :param tickers: Optional list of stocks to restrict to.
+
+    :return:        Array of the nD day numbers, in order.
+                    List of the nT stocks with prices on any of the days, sorted.
+                    nT x nD x nF array of the values of the fields, NaN where
+                    a stock has no price on a day.
+                    None if no data found.
+    """
+    ensureDateIndex(dbCon)
 
-    if len(daysAll) == 0:
-        # Have not found any data
+    r = executeQueryArray(dbCon, recentDatesSQL, (dateToDay(endDate), nDates), [('Date', np.int64)])
+    if len(r) < 1:
         return None
+    days = r['Date'][::-1]
+
+    tickers = [] if tickers == None else list(tickers)
+    queryStr = crossSectionSQL(fields, len(tickers), nDates=len(days))
+    if len(days) == 1:
+        pars = (int(days[0]),) + tuple(tickers)
+    else:
+        pars = (int(days[0]), int(days[-1])) + tuple(tickers)
+
+    r = executeQueryArray(dbCon, queryStr, pars, crossSectionDtype(fields))
+    if len(r) < 1:
+        return None
+
+    tickerList, rows = np.unique(r['Ticker'], return_inverse=True)
+    cols = np.searchsorted(days, r['Date'])
+
+    values = np.full((len(tickerList), len(days), len(fields)), np.nan)
+    values[rows, cols] = np.column_stack([r[field] for field in fields])
+
+    return days, tickerList.tolist(), values
+
+##########################################
 
-    excludeInds = []
-    for n, days in enumerate(daysAll):
-        if len(days) < 0.9 * maxDayCount:
-            excludeInds.append(n)
+def nextWeekday(day):
+    """
+    Find the first weekday on or after a given day.
+
+    :param day: Day number (days since 1970/01/01).
+    :return: Day number of the weekday.
+    """
+    # Day 0, 1970/01/01, was a Thursday.
+    weekday = (day + 3) % 7
+    if weekday >= 5:
+        day += 7 - weekday
+    return day
 
-    for n in excludeInds:
-        daysAll = daysAll[:n] + daysAll[(n+1):]
-        pricesAll = pricesAll[:n] + pricesAll[(n+1):]
-        tickersAll = tickersAll[:n] + tickersAll[(n+1):]
+##########################################
+
+def planUpdates(dbCon, tickers, end_date_str=None, default_start_str='2014-04-01'):
+    """
+    Work out which stocks need new prices and from when. The most recent
+    date for every stock is found with a single query. Stocks that already
+    have prices up to the last weekday before the end date are skipped, the
+    rest are grouped by the date their missing data starts from.
+
+    :param dbCon:             Database connection.
+    :param tickers:           The set of stocks to update.
+    :param end_date_str:      End of date range, format YYYY-MM-DD, today if not specified.
+    :param default_start_str: Start date for stocks with no data in the database.
+
+    :return: List of (start_date_str, tickers) pairs, ordered by start date.
+             List of the stocks that are already up to date.
+    """
 
+    if end_date_str == None:
+        end_date_str = datetime.date.today().isoformat()
 
-    daysCommon = set(daysAll[0])
-    for days in daysAll:
-        daysCommon = daysCommon.intersection(set(days))
+    endDay = dateToDay(end_date_str)
+    defaultStartDay = dateToDay(default_start_str)
 
-    daysCommon = np.asarray(list(daysCommon),dtype=np.int)
+    tickers = [t.upper() for t in tickers]
+
+    if len(tickers) == 0:
+        return [], []
+
+    # Each lookup of the latest date is a seek on the primary key.
+    queryStr = ('WITH t(Ticker) AS (VALUES ' + ', '.join(['(?)'] * len(tickers)) + ') ' +
+                'SELECT Ticker, (SELECT MAX(Date) FROM prices p WHERE p.Ticker = t.Ticker) ' +
+                'FROM t')
+    r = executeQuery2(dbCon, queryStr, tuple(tickers))
+
+    groups = {}
+    upToDate = []
+
+    for ticker, lastDay in r:
+        if lastDay == None:
+            startDay = defaultStartDay
+        else:
+            startDay = nextWeekday(lastDay + 1)
+
+        if startDay > endDay:
+            upToDate.append(ticker)
+            continue
 
-    for n, days in enumerate(daysAll):
-        ix = np.in1d(days, daysCommon)
-        pricesAll[n] = pricesAll[n][ix]
+        groups.setdefault(startDay, []).append(ticker)
 
+    plan = [(dayToDate(d, sep='-'), groups[d]) for d in sorted(groups)]
 
-    return daysCommon, np.array(pricesAll), tickersAll
\ No newline at end of file
+    return plan, upToDate